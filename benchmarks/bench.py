@@ -0,0 +1,245 @@
+"""
+Benchmarks of the manager operations on a synthetic game resource tree.
+
+    python benchmarks/bench.py --resources 10000 --output results.json
+    python benchmarks/bench.py --resources 10000 --compare results.json
+
+The game tree uses the `xx/<hash>` layout with log-normal file sizes, a mod source
+tree overrides part of it, and every operation is timed headlessly. Results are JSON
+so runs on different commits can be compared; --compare exits with 1 when an
+operation got slower than --threshold times its baseline.
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from manager import ModManager  # noqa: E402
+from manager.deploy import COPY, STRATEGIES  # noqa: E402
+
+# rows a tree page shows, see ListTreeComponent.PAGE_SIZE
+PAGE_SIZE = 200
+
+
+def file_sizes(rng: random.Random, count: int, median: int, sigma: float, max_size: int) -> list[int]:
+    # most bundles are a few KB, a long tail of textures and sounds goes into MB
+    return [min(max_size, max(16, int(rng.lognormvariate(math.log(median), sigma)))) for _ in range(count)]
+
+
+def write_file(rng: random.Random, path: str, size: int):
+    # half random, half repeated: game bundles compress a little, not a lot
+    half = size // 2
+    with open(path, "wb") as f:
+        f.write(rng.randbytes(half))
+        f.write(b"\0" * (size - half))
+
+
+def generate(root: str, args) -> dict:
+    """
+    A game tree of `resources` files and a mod tree overriding `mod_ratio` of them
+    """
+    rng = random.Random(args.seed)
+    game_path = os.path.join(root, "game")
+    source_path = os.path.join(root, "source")
+    hashes = ["%08x" % value for value in rng.sample(range(16 ** 8), args.resources)]
+    sizes = file_sizes(rng, len(hashes), args.median_size, args.sigma, args.max_size)
+    total = 0
+    for resource_hash, size in zip(hashes, sizes):
+        folder = os.path.join(game_path, resource_hash[:2])
+        os.makedirs(folder, exist_ok=True)
+        write_file(rng, os.path.join(folder, resource_hash), size)
+        total += size
+    modded = rng.sample(range(len(hashes)), max(1, int(len(hashes) * args.mod_ratio)))
+    for i in modded:
+        folder = os.path.join(source_path, hashes[i][:2])
+        os.makedirs(folder, exist_ok=True)
+        write_file(rng, os.path.join(folder, hashes[i]), sizes[i])
+    return {"game_path": game_path, "source_path": source_path, "files": len(hashes), "bytes": total,
+            "modded": len(modded)}
+
+
+class Timer:
+    def __init__(self, repeat: int) -> None:
+        self.repeat = repeat
+        self.results = {}
+
+    def measure(self, name: str, fn, setup=None, **info):
+        """
+        Run `fn` `repeat` times, `setup` before each run untimed
+        """
+        times = []
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        self.results[name] = dict(info, seconds=min(times), median=statistics.median(times), runs=len(times))
+        print(f"{name:<24} {min(times) * 1000:10.1f} ms", file=sys.stderr)
+
+
+def run(args) -> dict:
+    root = tempfile.mkdtemp(prefix="mdbench-", dir=args.dir)
+    try:
+        start = time.perf_counter()
+        tree = generate(root, args)
+        print(f"generated {tree['files']} files, {tree['bytes'] / 2**20:.1f} MB "
+              f"in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        local_path = os.path.join(root, "local")
+        os.makedirs(local_path)
+        timer = Timer(args.repeat)
+        manager = ModManager(local_path=local_path, target_path=tree["game_path"], deploy_strategy=args.strategy,
+                             durable=not args.no_fsync)
+        try:
+            # importing twice would only add duplicates, it is timed once
+            start = time.perf_counter()
+            resource_ids = manager.import_resources(tree["source_path"], resource_type="card")
+            timer.results["import_resources"] = {"seconds": time.perf_counter() - start, "runs": 1,
+                                                 "files": len(resource_ids)}
+            mod_size = max(1, len(resource_ids) // args.mods)
+            mod_ids = [manager.add_mod(resource_ids[i * mod_size:(i + 1) * mod_size], f"mod {i}", "", None)
+                       for i in range(args.mods)]
+            big = mod_ids[0]
+            files = mod_size
+
+            timer.measure("apply_mod", lambda: manager.apply_mod(big), setup=lambda: manager.reset_mod(big),
+                          files=files)
+            timer.measure("reset_mod", lambda: manager.reset_mod(big), setup=lambda: manager.apply_mod(big),
+                          files=files)
+            for mod_id in mod_ids:
+                manager.apply_mod(mod_id)
+            timer.measure("save_data", manager.save_data, records=len(manager.get_records()))
+            timer.measure("verify", manager.verify, files=len(resource_ids))
+            manager.save_profile("all")
+            manager.save_profile("half", mod_ids[::2])
+            timer.measure("switch_profile", lambda: manager.switch_profile("half"),
+                          setup=lambda: manager.switch_profile("all"))
+            # imported resources are named after their hash, a two letter prefix matches 1/256 of them.
+            # the index is built by the first search with a query, then kept in step
+            timer.measure("search_index", lambda: manager.search_resources("ab"), setup=manager._indexes.clear,
+                          files=len(resource_ids))
+            timer.measure("search_resources", lambda: manager.search_resources("ab"))
+            timer.measure("tree_page", lambda: [manager.get_resource(resource_id).name for resource_id
+                                                in manager.search_resources("")[:PAGE_SIZE]])
+            try:
+                import PIL  # noqa: F401
+            except ImportError:
+                timer.results["preview_render"] = {"skipped": "Pillow is not installed"}
+            else:
+                bench_preview(timer, manager, local_path, big)
+        finally:
+            manager.close()
+
+        def reopen():
+            ModManager(local_path=local_path, target_path=tree["game_path"], deploy_strategy=args.strategy).close()
+        timer.measure("load_data", reopen, records=len(manager.get_records()))
+
+        def cold_start():
+            # what the GUI does before its first resource page shows
+            with ModManager(local_path=local_path, target_path=tree["game_path"],
+                            deploy_strategy=args.strategy) as reopened:
+                reopened.search_mods("")
+                [reopened.get_resource(resource_id).name for resource_id in reopened.search_resources("")[:PAGE_SIZE]]
+        timer.measure("cold_start", cold_start, files=len(resource_ids))
+        stats = manager.resource_manager.backup_stats()
+        return {"meta": meta(args, tree), "backups": stats, "results": timer.results}
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_preview(timer: Timer, manager: ModManager, local_path: str, mod_id: str):
+    """
+    A 1080p preview shown from memory, from its thumbnail on disk and rendered again
+    """
+    from PIL import Image
+    preview = os.path.join(local_path, "preview_source.png")
+    Image.effect_noise((1920, 1080), 64).convert("RGB").save(preview)
+    manager.resource_manager.add_mod_preview(mod_id, preview)
+    cache = manager.resource_manager.preview_cache
+    size = (500, 500)
+    timer.measure("preview_render", lambda: manager.get_mod_preview(mod_id, size),
+                  setup=lambda: cache.invalidate(mod_id))
+    timer.measure("preview_disk_hit", lambda: manager.get_mod_preview(mod_id, size), setup=cache._entries.clear)
+    manager.get_mod_preview(mod_id, size)
+    timer.measure("preview_memory_hit", lambda: manager.get_mod_preview(mod_id, size))
+
+
+def meta(args, tree: dict) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+            "strategy": args.strategy, "seed": args.seed, "resources": tree["files"], "bytes": tree["bytes"],
+            "modded": tree["modded"], "mods": args.mods, "fsync": not args.no_fsync, "time": int(time.time())}
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> bool:
+    """
+    Print current/baseline per operation, False if any is above `threshold`
+    """
+    ok = True
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None or "seconds" not in base or "seconds" not in result:
+            continue
+        ratio = result["seconds"] / base["seconds"] if base["seconds"] else float("inf")
+        flag = ""
+        if ratio > threshold:
+            flag = "  SLOWER"
+            ok = False
+        print(f"{name:<24} {base['seconds'] * 1000:10.1f} -> {result['seconds'] * 1000:10.1f} ms "
+              f"x{ratio:.2f}{flag}")
+    return ok
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Benchmark the mod manager on a synthetic resource tree")
+    parser.add_argument("--resources", type=int, default=1000, help="files in the game tree, 1000 to 100000")
+    parser.add_argument("--mod-ratio", type=float, default=0.5, help="part of the game files the mods override")
+    parser.add_argument("--mods", type=int, default=4, help="mods the overrides are split into")
+    parser.add_argument("--median-size", type=int, default=16 * 1024, help="median file size in bytes")
+    parser.add_argument("--sigma", type=float, default=1.2, help="spread of the log-normal file sizes")
+    parser.add_argument("--max-size", type=int, default=8 * 2**20, help="largest file in bytes")
+    parser.add_argument("--strategy", choices=STRATEGIES, default=COPY)
+    parser.add_argument("--no-fsync", action="store_true", help="run batches with durable=False")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dir", default=None, help="where the trees are generated, the volume matters")
+    parser.add_argument("--output", default="-", help="json results file, - for stdout")
+    parser.add_argument("--compare", default=None, help="baseline json to compare the results with")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio that fails --compare")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # the manager reports progress on stdout, keep it for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args)
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=4)
+        print()
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+    if args.compare is not None:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            if not compare(json.load(f), results, args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
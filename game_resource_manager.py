@@ -1,5 +1,8 @@
 import PySimpleGUI as sg
-from manager import ModManager, Mod
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from manager import ModManager, Mod, Cancelled
 
 
 # def format_tree_resources(mods: list[Mod]) -> sg.TreeData:
@@ -9,47 +12,136 @@ from manager import ModManager, Mod
 #     return tree_data
 
 
-class Data:
-    def __init__(self, id, name) -> None:
-        self.id = id
-        self.name = name
+class ListTreeComponent:
+    """
+    A paged tree over a list of ids with a search box. Only one page of rows
+    exists in the widget at a time and names are looked up for those rows only.
+    `search(query)` returns the ids to list in order, `name_of(id)` the text of a row.
+    """
+    PAGE_SIZE = 200
 
-    @classmethod
-    def from_mod(cls, mod: Mod):
-        return cls(id=mod.id, name=mod.name)
+    def __init__(self, window, key, search, name_of) -> None:
+        self._window = window
+        self._key = key
+        self._search = search
+        self._name_of = name_of
+        self._query = ""
+        self._ids: list[str] = []
+        self._page = 0
+        # set when the ids changed while the tree was hidden, render() catches up
+        self.stale = True
 
-    @classmethod
-    def from_mods(cls, mods: list[Mod]):
-        return [cls.from_mod(mod) for mod in mods]
+    @property
+    def pages(self) -> int:
+        return max(1, -(-len(self._ids) // self.PAGE_SIZE))
 
-    @classmethod
-    def from_resource(cls, resource):
-        return cls(id=resource.id, name=resource.name)
+    def render(self, query=None):
+        """
+        Run the search again and show the current page
+        """
+        if query is not None and query != self._query:
+            self._query = query
+            self._page = 0
+        self._ids = self._search(self._query)
+        self._page = min(self._page, self.pages - 1)
+        self._show()
+        self.stale = False
 
-    @classmethod
-    def from_resources(cls, resources):
-        return [cls.from_resource(resource) for resource in resources]
+    def turn(self, delta: int):
+        page = min(max(self._page + delta, 0), self.pages - 1)
+        if page != self._page:
+            self._page = page
+            self._show()
 
+    def _show(self):
+        start = self._page * self.PAGE_SIZE
+        self._window[self.get_key()].update(
+            values=self.generate_tree(self._ids[start:start + self.PAGE_SIZE], self._name_of))
+        self._update_label()
 
-class ListTreeComponent:
-    def __init__(self, window, key) -> None:
-        self._window = window
-        self._key = key
+    def _update_label(self):
+        self._window[self._key+"PAGE-"].update(f"{self._page + 1}/{self.pages} ({len(self._ids)})")
+
+    def _insert_row(self, id):
+        # straight into the ttk widget, PySimpleGUI only maps its row ids to our keys
+        tree = self._window[self.get_key()]
+        row = tree.Widget.insert("", "end", text=self._name_of(id), values=[])
+        tree.KeyToID[id] = row
+        tree.IdToKey[row] = id
 
-    def render(self, data_list: list[Data]):
-        the_key = self._key+"TREE-"
-        self._window[the_key].update(values=self.generate_tree(data_list))
+    def _delete_row(self, id):
+        tree = self._window[self.get_key()]
+        row = tree.KeyToID.pop(id, None)
+        if row is not None:
+            tree.IdToKey.pop(row, None)
+            tree.Widget.delete(row)
+
+    def insert(self, id):
+        """
+        Show a new id without rebuilding the tree, new ids come last
+        """
+        if self.stale:
+            return
+        if self._query:
+            # whether it matches is up to the search
+            self.render()
+            return
+        self._ids.append(id)
+        if len(self._ids) - 1 < (self._page + 1) * self.PAGE_SIZE:
+            self._insert_row(id)
+        self._update_label()
+
+    def delete(self, id):
+        """
+        Drop a deleted id, the first row of the next page moves up
+        """
+        if self.stale:
+            return
+        try:
+            position = self._ids.index(id)
+        except ValueError:
+            return
+        del self._ids[position]
+        end = (self._page + 1) * self.PAGE_SIZE
+        if position < self._page * self.PAGE_SIZE:
+            # every row of this page moved
+            self._show()
+            return
+        self._delete_row(id)
+        if position < end <= len(self._ids):
+            self._insert_row(self._ids[end - 1])
+        if self._page >= self.pages:
+            self.turn(-1)
+        self._update_label()
+
+    def handle(self, event, values) -> bool:
+        """
+        Search and page events of this component, True if it was one
+        """
+        if event == self._key+"SEARCH-":
+            self.render(values[event])
+        elif event == self._key+"PREV-":
+            self.turn(-1)
+        elif event == self._key+"NEXT-":
+            self.turn(1)
+        else:
+            return False
+        return True
 
     @staticmethod
-    def generate_tree(data_list: list[Data]):
+    def generate_tree(ids, name_of):
         tree_data = sg.TreeData()
-        for data in data_list:
-            tree_data.Insert("", data.id, data.name, values=[])
+        for id in ids:
+            tree_data.Insert("", id, name_of(id), values=[])
         return tree_data
 
-    def layout(self, tree_data=sg.TreeData()):
-        return sg.Tree(data=tree_data, headings=[], auto_size_columns=True,
-                       num_rows=20, col0_width=20, key=self._key+"TREE-", show_expanded=False, enable_events=True,)
+    def layout(self):
+        return sg.Column([
+            [sg.Input(key=self._key+"SEARCH-", size=(24, 1), enable_events=True)],
+            [sg.Tree(data=sg.TreeData(), headings=[], auto_size_columns=True,
+                     num_rows=20, col0_width=20, key=self.get_key(), show_expanded=False, enable_events=True,)],
+            [sg.Button("<", key=self._key+"PREV-"), sg.Text("", size=(14, 1), key=self._key+"PAGE-"),
+             sg.Button(">", key=self._key+"NEXT-")]])
 
     def get_key(self):
         return self._key+"TREE-"
@@ -73,14 +165,111 @@ class InfoPreviewComponent:
                           [sg.Text("Description", key=self._key+"DES-")]])
 
 
+class Worker:
+    """
+    Run ModManager operations off the event loop. Jobs run one at a time in
+    submission order, so every change of the manager goes through here and
+    never races another one. Results come back as window events:
+    (key, result) on success, ("-WORKER-ERROR-", (key, error)) on failure
+    and ("-WORKER-CANCELLED-", key) when cancelled.
+    """
+    PROGRESS_KEY = "-WORKER-PROGRESS-"
+    ERROR_KEY = "-WORKER-ERROR-"
+    CANCELLED_KEY = "-WORKER-CANCELLED-"
+    # progress events are throttled to one per frame at 60 fps
+    PROGRESS_INTERVAL = 1 / 60
+
+    def __init__(self, window) -> None:
+        self._window = window
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._last_progress = 0.0
+        self.pending = 0
+        # queued or running jobs per subject, e.g. the mod they apply
+        self._subjects: dict[str, int] = {}
+
+    def submit(self, key, fn, *args, progress=False, subject=None, **kwargs):
+        """
+        Queue `fn(*args, **kwargs)`, with `progress=True` it also gets the
+        progress and cancel arguments of ModManager.apply_mod/reset_mod.
+        `busy(subject)` is True until the job is done.
+        """
+        with self._lock:
+            self.pending += 1
+            if subject is not None:
+                self._subjects[subject] = self._subjects.get(subject, 0) + 1
+        if progress:
+            kwargs["progress"] = self._progress
+            kwargs["cancel"] = self._cancel
+        self._executor.submit(self._run, key, fn, args, kwargs, subject)
+
+    def busy(self, subject) -> bool:
+        with self._lock:
+            return subject in self._subjects
+
+    def _run(self, key, fn, args, kwargs, subject):
+        try:
+            if self._cancel.is_set():
+                raise Cancelled(key)
+            result = fn(*args, **kwargs)
+        except Cancelled:
+            self._window.write_event_value(self.CANCELLED_KEY, key)
+        except Exception as e:
+            self._window.write_event_value(self.ERROR_KEY, (key, e))
+        else:
+            self._window.write_event_value(key, result)
+        finally:
+            with self._lock:
+                self.pending -= 1
+                if subject is not None:
+                    self._subjects[subject] -= 1
+                    if not self._subjects[subject]:
+                        del self._subjects[subject]
+                if self.pending == 0:
+                    self._cancel.clear()
+
+    def _progress(self, done, total):
+        now = time.monotonic()
+        if done < total and now - self._last_progress < self.PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        self._window.write_event_value(self.PROGRESS_KEY, (done, total))
+
+    def cancel(self):
+        """
+        Stop the running job before its next file and drop the queued ones
+        """
+        with self._lock:
+            if self.pending:
+                self._cancel.set()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
 # TODO: 组件式编程
 
 class App:
+    # milliseconds between checks for game updates
+    SYNC_INTERVAL = 2000
+
     def __init__(self) -> None:
         local_path = sg.popup_get_folder("选择本地Mod路径")
-        game_resource_path = sg.popup_get_folder("选择游戏资源路径")
-        self.mod_manager = ModManager(
-            local_path=local_path, target_path=game_resource_path)
+        self.mod_manager = ModManager(local_path=local_path)
+        # 游戏目录只在第一次选择, 换目录会作废旧目录的备份
+        if self.mod_manager.target not in self.mod_manager.get_targets():
+            game_resource_path = sg.popup_get_folder("选择游戏资源路径")
+            self.mod_manager.add_target(self.mod_manager.target, game_resource_path)
+
+    def delete_mod(self, mod_id):
+        # worker jobs return what the tree has to drop
+        self.mod_manager.delete_mod(mod_id)
+        return mod_id
+
+    def delete_resource(self, resource_id):
+        self.mod_manager.delete_resource(resource_id)
+        return resource_id
 
     def import_resource(self):
         layout = [
@@ -111,11 +300,11 @@ class App:
     def create_mod(self):
         # Choose Resource From A Tree to Create A Mod
         info_preview = InfoPreviewComponent(None, key="-INFO-")
-        resource_tree = ListTreeComponent(None, key="-THE-RESOURCE-")
+        resource_tree = ListTreeComponent(None, "-THE-RESOURCE-", self.mod_manager.search_resources,
+                                          lambda resource_id: self.mod_manager.get_resource(resource_id).name)
         layout = [
             [sg.Text("选择资源：")],
-            [resource_tree.layout(ListTreeComponent.generate_tree(Data.from_resources(self.mod_manager.get_resources()))),
-             info_preview.layout()],
+            [resource_tree.layout(), info_preview.layout()],
             [sg.Text("Mod资源：")],
             [sg.Input(key="-RESOURCE-")],
             [sg.Text("Mod名称：")],
@@ -129,10 +318,10 @@ class App:
             [sg.Button(key="-COMMIT-", button_text="确定"),
              sg.Button(key="-CANCEL-", button_text="取消")],
         ]
-        window = sg.Window("新建Mod", layout)
+        window = sg.Window("新建Mod", layout, finalize=True)
         info_preview._window = window
         resource_tree._window = window
-        # resource_tree.render(Data.from_resources(self.mod_manager.get_resources()))
+        resource_tree.render()
         resource_ids = set()
         while True:
             event, values = window.read()
@@ -140,7 +329,11 @@ class App:
             if event in (sg.WINDOW_CLOSED, "取消"):
                 window.close()
                 return None
+            elif resource_tree.handle(event, values):
+                continue
             elif event == resource_tree.get_key():
+                if len(values[event]) == 0:
+                    continue
                 resource_id = values[resource_tree.get_key()][0]
                 resource = self.mod_manager.get_resource(resource_id)
                 info_preview.render(resource.name, resource.description, None)
@@ -158,7 +351,7 @@ class App:
                     resource_id).name for resource_id in resource_ids]
                 window["-RESOURCE-"].update(",".join(resource_names))
             elif event == "-REMOVE-":
-                resource_id = values["-TREE-"][0]
+                resource_id = values[resource_tree.get_key()][0]
                 resource_ids.remove(resource_id)
                 resource_names = [self.mod_manager.get_resource(
                     resource_id).name for resource_id in resource_ids]
@@ -166,8 +359,10 @@ class App:
 
     def run(self):
         sg.theme("Dark Blue 3")
-        tree_mod = ListTreeComponent(None, "-MAIN-MOD-")
-        tree_resource = ListTreeComponent(None, "-MAIN-RESOURCE-")
+        tree_mod = ListTreeComponent(None, "-MAIN-MOD-", self.mod_manager.search_mods,
+                                     lambda mod_id: self.mod_manager.get_mod(mod_id).name)
+        tree_resource = ListTreeComponent(None, "-MAIN-RESOURCE-", self.mod_manager.search_resources,
+                                          lambda resource_id: self.mod_manager.get_resource(resource_id).name)
         tree_tab_group = sg.TabGroup([
             [
                 sg.Tab("Mod", [[tree_mod.layout()]], key="-TAB-MOD-"),
@@ -182,66 +377,126 @@ class App:
             [tree_tab_group, sg.VSeperator(), previewer.layout()],
             [sg.Button(key="-APPLY-", button_text="应用"),
              sg.Button(key="-RESET-", button_text="重置"),
-             sg.Button(key="-DELETE-", button_text="删除")]
+             sg.Button(key="-DELETE-", button_text="删除"),
+             sg.Button(key="-VERIFY-", button_text="校验修复")],
+            [sg.ProgressBar(100, orientation="h", size=(30, 15), key="-PROGRESS-"),
+             sg.Text("", size=(30, 1), key="-STATUS-"),
+             sg.Button(key="-CANCEL-", button_text="取消")]
         ]
-        window = sg.Window("Md Mod 管理器", layout)
+        window = sg.Window("Md Mod 管理器", layout, finalize=True)
         tree_mod._window = window
         tree_resource._window = window
         previewer._window = window
+        tree_mod.render()
+        # disk work is queued on one worker, previews get their own so they never wait behind a copy
+        worker = Worker(window)
+        preview_worker = Worker(window)
+        selected_mod_id = None
+        # game updates are picked up between jobs, only the changed files are checked
+        self.mod_manager.watch()
 
         while True:
-            event, values = window.read()
-            print(event, values)
+            event, values = window.read(timeout=self.SYNC_INTERVAL)
+            if event not in (Worker.PROGRESS_KEY, sg.TIMEOUT_KEY, "-SYNC-DONE-"):
+                print(event, values)
             if event == sg.WINDOW_CLOSED:
                 # 处理窗口关闭事件
+                worker.cancel()
+                worker.shutdown()
+                preview_worker.shutdown()
                 self.mod_manager.close()
                 break
             elif event == "-LOAD-RESOURCE-":
                 the_resource = self.import_resource()
                 if the_resource is not None:
-                    self.mod_manager.add_resource(
-                        the_resource["filename"], the_resource["name"], the_resource["description"], the_resource["resource_type"])
-                # update tree
-                tree_resource.render(
-                    Data.from_resources(self.mod_manager.get_resources()))
+                    worker.submit("-RESOURCE-ADDED-", self.mod_manager.add_resource,
+                                  the_resource["filename"], the_resource["name"], the_resource["description"], the_resource["resource_type"])
+                    window["-STATUS-"].update("导入中...")
+            elif event == "-RESOURCE-ADDED-":
+                window["-STATUS-"].update("导入完成")
+                tree_resource.insert(values[event])
             elif event == "-New-Mod-":
                 the_mod = self.create_mod()
                 if the_mod is not None:
-                    self.mod_manager.add_mod(
-                        the_mod["resource_ids"], the_mod["name"], the_mod["description"], the_mod["image"])
-                # update tree
-                tree_mod.render(
-                    Data.from_mods(self.mod_manager.get_mods()))
+                    worker.submit("-MOD-ADDED-", self.mod_manager.add_mod,
+                                  the_mod["resource_ids"], the_mod["name"], the_mod["description"], the_mod["image"])
+            elif event == "-MOD-ADDED-":
+                tree_mod.insert(values[event])
             elif event == "-TAB-GROUP-":
-                if window['-TAB-GROUP-'].get() == "-TAB-MOD-":
-                    tree_mod.render(
-                        Data.from_mods(self.mod_manager.get_mods()))
-                elif window['-TAB-GROUP-'].get() == "-TAB-RESOURCE-":
-                    tree_resource.render(
-                        Data.from_resources(self.mod_manager.get_resources()))
+                # the trees keep their rows across tabs, only the first visit fills one
+                if window['-TAB-GROUP-'].get() == "-TAB-MOD-" and tree_mod.stale:
+                    tree_mod.render()
+                elif window['-TAB-GROUP-'].get() == "-TAB-RESOURCE-" and tree_resource.stale:
+                    tree_resource.render()
+            elif tree_mod.handle(event, values) or tree_resource.handle(event, values):
+                continue
             elif event == "-APPLY-":
-                if window['-TAB-GROUP-'].get() == "-TAB-MOD-":
+                if window['-TAB-GROUP-'].get() == "-TAB-MOD-" and values["-MAIN-MOD-TREE-"]:
                     mod_id = values["-MAIN-MOD-TREE-"][0]
-                    self.mod_manager.apply_mod(mod_id)
+                    worker.submit("-APPLY-DONE-", self.mod_manager.apply_mod, mod_id, progress=True, subject=mod_id)
+                    window["-STATUS-"].update(f"应用中... (队列 {worker.pending})")
             elif event == "-RESET-":
-                if window['-TAB-GROUP-'].get() == "-TAB-MOD-":
+                if window['-TAB-GROUP-'].get() == "-TAB-MOD-" and values["-MAIN-MOD-TREE-"]:
                     mod_id = values["-MAIN-MOD-TREE-"][0]
-                    self.mod_manager.reset_mod(mod_id)
+                    worker.submit("-RESET-DONE-", self.mod_manager.reset_mod, mod_id, progress=True, subject=mod_id)
+                    window["-STATUS-"].update(f"重置中... (队列 {worker.pending})")
+            elif event in ("-APPLY-DONE-", "-RESET-DONE-"):
+                window["-PROGRESS-"].update(100, 100)
+                window["-STATUS-"].update(f"完成: {values[event]}")
+            elif event == "-VERIFY-":
+                worker.submit("-VERIFY-DONE-", self.mod_manager.verify, repair=True)
+                window["-STATUS-"].update("校验中...")
+            elif event == "-VERIFY-DONE-":
+                window["-STATUS-"].update(f"校验完成: {values[event]}")
+            elif event == sg.TIMEOUT_KEY:
+                if worker.pending == 0:
+                    worker.submit("-SYNC-DONE-", self.mod_manager.sync)
+            elif event == "-SYNC-DONE-":
+                if values[event] is not None and not values[event].clean:
+                    window["-STATUS-"].update(f"游戏文件已更新并修复: {values[event]}")
+            elif event == "-CANCEL-":
+                worker.cancel()
+            elif event == Worker.PROGRESS_KEY:
+                done, total = values[event]
+                window["-PROGRESS-"].update(done, max(total, 1))
+            elif event == Worker.CANCELLED_KEY:
+                window["-STATUS-"].update("已取消")
+            elif event == Worker.ERROR_KEY:
+                key, error = values[event]
+                window["-STATUS-"].update("出错")
+                sg.popup(f"{key} {error}")
             elif event == "-DELETE-":
-                if window['-TAB-GROUP-'].get() == "-TAB-MOD-":
+                # on the worker as well, a delete checked while an apply is still running would pass
+                if window['-TAB-GROUP-'].get() == "-TAB-MOD-" and values["-MAIN-MOD-TREE-"]:
                     mod_id = values["-MAIN-MOD-TREE-"][0]
-                    self.mod_manager.delete_mod(mod_id)
-                    tree_mod.render(
-                        Data.from_mods(self.mod_manager.get_mods()))
+                    if worker.busy(mod_id):
+                        sg.popup(f"Mod {mod_id} 正在应用或重置, 请等待完成后再删除")
+                        continue
+                    worker.submit("-MOD-DELETED-", self.delete_mod, mod_id, subject=mod_id)
+                elif window['-TAB-GROUP-'].get() == "-TAB-RESOURCE-" and values["-MAIN-RESOURCE-TREE-"]:
+                    resource_id = values["-MAIN-RESOURCE-TREE-"][0]
+                    worker.submit("-RESOURCE-DELETED-", self.delete_resource, resource_id)
+            elif event == "-MOD-DELETED-":
+                tree_mod.delete(values[event])
+                if values[event] == selected_mod_id:
+                    selected_mod_id = None
+            elif event == "-RESOURCE-DELETED-":
+                tree_resource.delete(values[event])
             elif event == tree_mod.get_key():  # 实际上就一个Key
                 if len(values[event]) == 0:
                     continue
                 mod_id = values[event][0]
+                selected_mod_id = mod_id
                 mod = self.mod_manager.get_mod(mod_id)
-                previewer.render(
-                    mod.name, mod.description, self.mod_manager.get_mod_preview(
-                        mod_id, size=(500, 500))
-                )
+                previewer.render(mod.name, mod.description, None)
+                # the mod may be deleted before its preview is done, so the preview carries its text
+                preview_worker.submit("-PREVIEW-DONE-", lambda mod: (
+                    mod.id, mod.name, mod.description, self.mod_manager.get_mod_preview(mod.id, size=(500, 500))), mod)
+            elif event == "-PREVIEW-DONE-":
+                mod_id, name, description, image = values[event]
+                # ignore previews of a mod which is no longer selected
+                if mod_id == selected_mod_id:
+                    previewer.render(name, description, image)
             elif event == tree_resource.get_key():
                 if len(values[event]) == 0:
                     continue
@@ -249,7 +504,6 @@ class App:
                 resource = self.mod_manager.get_resource(resource_id)
                 previewer.render(resource.name, resource.description, None)
 
-
 if __name__ == "__main__":
     App().run()
     # main()
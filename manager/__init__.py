@@ -1,4 +1,7 @@
-from .mod_manager import ModManager, Mod, Record, Resource
+from .mod_manager import ModManager, Mod, Record, RecordStore, Resource, Target
 from .resource_manager import ResourceManager
+from .batch import BatchResult, Cancelled
+from .metrics import Metrics, Recorder
 
-__all__ = ["ModManager", "Mod", "Record", "ResourceManager", "Resource"]
+__all__ = ["BatchResult", "Cancelled", "Metrics", "ModManager", "Mod", "Record", "RecordStore", "Recorder",
+           "ResourceManager", "Resource", "Target"]
@@ -0,0 +1,372 @@
+import json
+import lzma
+import os
+import uuid
+import zlib
+from typing import Callable, Iterator, Optional
+from .batch import fsync_file
+from .deploy import STAGING_SUFFIX, clone_or_copy, staging_path
+from .integrity import CHUNK_SIZE, DRIFTED, MISSING, OK, fast_digest, new_fast_hasher
+from .metrics import NULL_METRICS, Metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+RAW = "raw"
+ZSTD = "zstd"
+ZLIB = "zlib"
+LZMA = "lzma"
+# not stored at all, the identical file of a game-patch snapshot is restored instead
+SNAPSHOT = "snapshot"
+CODECS = (RAW, ZSTD, ZLIB, LZMA)
+
+# a first chunk which does not shrink below this ratio is stored raw,
+# most game bundles are compressed already
+RAW_RATIO = 0.9
+POINTER_MAGIC = b"MDBACKUP\n"
+# what a damaged object raises while it is decompressed
+_DECODE_ERRORS = (OSError, zlib.error, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def default_codec() -> str:
+    return ZSTD if zstandard is not None else ZLIB
+
+
+def _compressor(codec: str):
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    if codec == ZLIB:
+        return zlib.compressobj(3)
+    return lzma.LZMACompressor(preset=1)
+
+
+def _decompressor(codec: str):
+    if codec == ZSTD:
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == ZLIB:
+        return zlib.decompressobj()
+    return lzma.LZMADecompressor()
+
+
+def _compressed_size(codec: str, data: bytes) -> int:
+    compressor = _compressor(codec)
+    return len(compressor.compress(data)) + len(compressor.flush())
+
+
+class BackupStore:
+    """
+    Compressed, deduplicated backups of original game files.
+
+    `backup/<xx>/<resource_hash>` is a small pointer file (POINTER_MAGIC + json with
+    digest, codec, size and the stat of the object). The content is stored once per
+    fast digest in `backup_store/<digest[:2]>/<digest>.<codec>`. Backups from before
+    the store are plain copies without the magic and are read as raw objects until
+    migrate() converts them.
+
+    Pointers are staged next to their final path like every other file of a batch,
+    objects are written and renamed by put() before the pointer is staged.
+
+    Several game directories can share one object store, each with its own pointers.
+    `pointer_roots()` lists the pointer folders of all of them, gc() keeps every
+    object any of them refers to.
+    """
+
+    def __init__(self, pointer_root: str, root: str, codec: Optional[str] = None,
+                 snapshot_path: Optional[str] = None, durable: bool = True,
+                 metrics: Metrics = NULL_METRICS, pointer_roots: Optional[Callable[[], list[str]]] = None) -> None:
+        self.metrics = metrics
+        self.pointer_root = pointer_root
+        self.root = root
+        self.pointer_roots = pointer_roots or (lambda: [pointer_root])
+        self.codec = codec or default_codec()
+        if self.codec not in CODECS or (self.codec == ZSTD and zstandard is None):
+            raise ValueError(f"Unsupported backup codec {self.codec}")
+        # `<xx>/<resource_hash>` tree of pristine game files of the current patch
+        self.snapshot_path = snapshot_path
+        self.durable = durable
+        self.loaded = os.path.isdir(root)
+        os.makedirs(root, exist_ok=True)
+
+    def pointer_file(self, resource_hash: str) -> str:
+        return os.path.join(self.pointer_root, resource_hash[:2], resource_hash)
+
+    def object_path(self, digest: str, codec: str) -> str:
+        return os.path.join(self.root, digest[:2], f"{digest}.{codec}")
+
+    def snapshot_file(self, resource_hash: str) -> str:
+        return os.path.join(self.snapshot_path, resource_hash[:2], resource_hash)
+
+    def read(self, resource_hash: str) -> Optional[dict]:
+        """
+        The pointer of a backup, None without one
+        """
+        return self._read(self.pointer_file(resource_hash))
+
+    @staticmethod
+    def _read(path: str) -> Optional[dict]:
+        try:
+            with open(path, "rb") as f:
+                if f.read(len(POINTER_MAGIC)) != POINTER_MAGIC:
+                    return {"digest": None, "codec": RAW, "size": os.path.getsize(path), "stat": None, "path": path}
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def source(self, resource_hash: str, pointer: dict) -> str:
+        """
+        The file holding the content of a backup
+        """
+        if "path" in pointer:
+            return pointer["path"]
+        if pointer["codec"] == SNAPSHOT:
+            return self.snapshot_file(resource_hash)
+        return self.object_path(pointer["digest"], pointer["codec"])
+
+    def _find(self, digest: str) -> Optional[str]:
+        for codec in CODECS:
+            if os.path.exists(self.object_path(digest, codec)):
+                return codec
+        return None
+
+    def _match_snapshot(self, resource_hash: str, src: str) -> Optional[dict]:
+        # two reads and no write, still cheaper than compressing
+        try:
+            st = os.stat(self.snapshot_file(resource_hash))
+        except FileNotFoundError:
+            return None
+        if st.st_size != os.path.getsize(src):
+            return None
+        digest = fast_digest(src)
+        if fast_digest(self.snapshot_file(resource_hash)) != digest:
+            return None
+        return {"digest": digest, "codec": SNAPSHOT, "size": st.st_size, "stat": [st.st_size, st.st_mtime_ns]}
+
+    def put(self, resource_hash: str, src: str) -> dict:
+        """
+        Store the content of `src` unless an identical object or snapshot file exists,
+        hashing while compressing, and return the pointer to it.
+        Content which does not compress is cloned as is where the volume can reflink.
+        """
+        if self.snapshot_path is not None:
+            pointer = self._match_snapshot(resource_hash, src)
+            if pointer is not None:
+                self.metrics.count("backup.snapshot")
+                return pointer
+        hasher = new_fast_hasher()
+        tmp_path = os.path.join(self.root, uuid.uuid4().hex + ".tmp")
+        size = 0
+        try:
+            codec = self.codec
+            if codec != RAW:
+                with open(src, "rb") as fsrc:
+                    chunk = fsrc.read(CHUNK_SIZE)
+                if _compressed_size(codec, chunk) > RAW_RATIO * len(chunk):
+                    codec = RAW
+            if codec == RAW:
+                # the clone shares the extents of `src`, the digest is of what was cloned
+                clone_or_copy(src, tmp_path)
+                with open(tmp_path, "rb") as f:
+                    while chunk := f.read(CHUNK_SIZE):
+                        hasher.update(chunk)
+                        size += len(chunk)
+                if self.durable:
+                    fsync_file(tmp_path)
+            else:
+                compressor = _compressor(codec)
+                with open(src, "rb") as fsrc, open(tmp_path, "wb") as fdst:
+                    while chunk := fsrc.read(CHUNK_SIZE):
+                        hasher.update(chunk)
+                        size += len(chunk)
+                        fdst.write(compressor.compress(chunk))
+                    fdst.write(compressor.flush())
+                    if self.durable:
+                        fdst.flush()
+                        os.fsync(fdst.fileno())
+            digest = hasher.hexdigest()
+            existing = self._find(digest)
+            if existing is not None:
+                os.remove(tmp_path)
+                codec = existing
+                self.metrics.count("backup.dedup")
+            else:
+                os.makedirs(os.path.join(self.root, digest[:2]), exist_ok=True)
+                os.replace(tmp_path, self.object_path(digest, codec))
+                self.metrics.count("backup.raw" if codec == RAW else "backup.compressed")
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        st = os.stat(self.object_path(digest, codec))
+        self.metrics.count("backup.bytes", size)
+        if existing is None:
+            self.metrics.count("backup.stored_bytes", st.st_size)
+        return {"digest": digest, "codec": codec, "size": size, "stat": [st.st_size, st.st_mtime_ns]}
+
+    @staticmethod
+    def _write_pointer(pointer: dict, path: str):
+        with open(path, "wb") as f:
+            f.write(POINTER_MAGIC)
+            f.write(json.dumps(pointer).encode())
+
+    def stage(self, src: str, dst: str) -> str:
+        """
+        Back up `src` as `dst`, the pointer file is staged next to `dst` for the batch to rename
+        """
+        pointer = self.put(os.path.basename(dst), src)
+        tmp_path = staging_path(dst)
+        self._write_pointer(pointer, tmp_path)
+        return tmp_path
+
+    def _content(self, codec: str, path: str) -> Iterator[bytes]:
+        with open(path, "rb") as f:
+            if codec in (RAW, SNAPSHOT):
+                while chunk := f.read(CHUNK_SIZE):
+                    yield chunk
+                return
+            decompressor = _decompressor(codec)
+            while chunk := f.read(CHUNK_SIZE):
+                yield decompressor.decompress(chunk)
+            if hasattr(decompressor, "flush"):
+                yield decompressor.flush()
+
+    def _content_digest(self, codec: str, path: str) -> str:
+        hasher = new_fast_hasher()
+        for chunk in self._content(codec, path):
+            hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def stage_restore(self, resource_hash: str, dst: str,
+                      copy: Callable[[str, str], str]) -> tuple[str, Optional[str]]:
+        """
+        Stage the original content of `resource_hash` next to `dst`, return the
+        staged path and the fast digest of the content. Uncompressed objects and
+        snapshot files go through `copy(src, dst) -> staged path` so they can be reflinked.
+        """
+        pointer = self.read(resource_hash)
+        if pointer is None:
+            raise FileNotFoundError(f"No backup of {resource_hash}")
+        path = self.source(resource_hash, pointer)
+        codec = pointer["codec"]
+        if codec == SNAPSHOT and self.check(resource_hash, pointer) != OK:
+            raise ValueError(f"Snapshot file {path} changed since the backup of {resource_hash}")
+        if codec in (RAW, SNAPSHOT):
+            return copy(path, dst), pointer["digest"]
+        tmp_path = staging_path(dst)
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in self._content(codec, path):
+                    f.write(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path, pointer["digest"]
+
+    def check(self, resource_hash: str, pointer: Optional[dict] = None) -> Optional[str]:
+        """
+        OK, DRIFTED or MISSING for the stored content of a backup, None without a backup.
+        The object is only decompressed and hashed when its stat changed.
+        """
+        if pointer is None:
+            try:
+                pointer = self.read(resource_hash)
+            except ValueError:
+                return DRIFTED
+            if pointer is None:
+                return None
+        path = self.source(resource_hash, pointer)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return MISSING
+        if pointer["digest"] is None or pointer["stat"] == [st.st_size, st.st_mtime_ns]:
+            return OK
+        try:
+            digest = self._content_digest(pointer["codec"], path)
+        except _DECODE_ERRORS:
+            return DRIFTED
+        return OK if digest == pointer["digest"] else DRIFTED
+
+    def digest(self, resource_hash: str) -> Optional[str]:
+        pointer = self.read(resource_hash)
+        return None if pointer is None else pointer["digest"]
+
+    def size(self, resource_hash: str) -> int:
+        return self.read(resource_hash)["size"]
+
+    def pointers(self, pointer_root: Optional[str] = None, staged: bool = False) -> Iterator[tuple[str, dict]]:
+        """
+        (resource_hash, pointer) of every backup in `pointer_root`, ours by default.
+        With `staged` the pointers a running batch has not renamed yet come too.
+        """
+        pointer_root = pointer_root or self.pointer_root
+        try:
+            shards = os.listdir(pointer_root)
+        except FileNotFoundError:
+            return
+        for shard in shards:
+            shard_path = os.path.join(pointer_root, shard)
+            if not os.path.isdir(shard_path):
+                continue
+            for name in os.listdir(shard_path):
+                if name.endswith(STAGING_SUFFIX) and not staged:
+                    continue
+                try:
+                    pointer = self._read(os.path.join(shard_path, name))
+                except ValueError:
+                    continue
+                if pointer is None:
+                    continue
+                if name.endswith(STAGING_SUFFIX):
+                    # `<resource_hash>.<random><STAGING_SUFFIX>`, see staging_path()
+                    name = name[:-len(STAGING_SUFFIX)].rsplit(".", 1)[0]
+                yield name, pointer
+
+    def migrate(self):
+        """
+        Turn plain copies from before the store into pointers to compressed objects, in place
+        """
+        for resource_hash, pointer in list(self.pointers()):
+            if "path" not in pointer:
+                continue
+            tmp_path = staging_path(pointer["path"])
+            self._write_pointer(self.put(resource_hash, pointer["path"]), tmp_path)
+            os.replace(tmp_path, pointer["path"])
+
+    def gc(self) -> int:
+        """
+        Remove every object no pointer of any game directory refers to, return the number removed
+        """
+        # staged pointers count, their objects are in place before them
+        live = {os.path.basename(self.source(resource_hash, pointer)) for pointer_root in self.pointer_roots()
+                for resource_hash, pointer in self.pointers(pointer_root, staged=True)}
+        removed = 0
+        for shard in os.listdir(self.root):
+            shard_path = os.path.join(self.root, shard)
+            if not os.path.isdir(shard_path):
+                continue
+            for name in os.listdir(shard_path):
+                if name not in live:
+                    os.remove(os.path.join(shard_path, name))
+                    removed += 1
+        return removed
+
+    def stats(self) -> dict:
+        """
+        Number of backups, their original size and what they take on disk
+        """
+        backups = 0
+        original = 0
+        objects = {}
+        snapshot = 0
+        for resource_hash, pointer in self.pointers():
+            backups += 1
+            original += pointer["size"]
+            if pointer["codec"] == SNAPSHOT:
+                snapshot += 1
+            else:
+                path = self.source(resource_hash, pointer)
+                objects[path] = pointer["stat"][0] if pointer["stat"] else pointer["size"]
+        return {"backups": backups, "bytes": original, "stored_bytes": sum(objects.values()),
+                "objects": len(objects), "snapshot": snapshot}
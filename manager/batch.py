@@ -0,0 +1,186 @@
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+from .deploy import remove_file, replace_file
+from .metrics import NULL_METRICS, Metrics
+
+
+# files staged, fsynced and renamed together in one step of a shard group
+SYNC_BATCH = 64
+
+
+def default_workers() -> int:
+    return min(8, (os.cpu_count() or 1) * 2)
+
+
+def fsync_file(path: str):
+    try:
+        fd = os.open(path, os.O_RDWR if os.name == "nt" else os.O_RDONLY)
+    except PermissionError:
+        # a sealed link into the library on Windows, its content is on disk already
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(path: str):
+    # directories can not be opened for fsync on Windows, renames are journaled by NTFS there
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CopyTask:
+    __slots__ = ("src", "dst", "copy", "key")
+
+    def __init__(self, src: str, dst: str, copy: Callable[[str, str], Optional[str]] = shutil.copyfile,
+                 key: Optional[str] = None) -> None:
+        self.src = src
+        self.dst = dst
+        # copies in place and returns None, or stages a file and returns its path,
+        # then the batch renames it over dst
+        self.copy = copy
+        # reported in `completed` once the copy is done, None for helper copies (backups)
+        self.key = key
+
+
+class BatchPlan:
+    """
+    Copies planned up front, grouped by the `xx` shard directory.
+    Tasks inside one shard run in order, so a backup copy always happens
+    before the game file is overwritten.
+
+    Staged tasks are committed in steps of SYNC_BATCH files: stage them all,
+    fsync them, rename each over its destination in order, fsync the directories.
+    A live file is never half written, only ever replaced by a complete one.
+    """
+
+    def __init__(self) -> None:
+        self.groups: dict[str, list[CopyTask]] = {}
+
+    def add(self, shard: str, src: str, dst: str, copy: Callable[[str, str], Optional[str]] = shutil.copyfile,
+            key: Optional[str] = None):
+        self.groups.setdefault(shard, []).append(CopyTask(src, dst, copy, key))
+
+    def __len__(self) -> int:
+        return sum(len(tasks) for tasks in self.groups.values())
+
+
+class BatchResult:
+    def __init__(self, files: int = 0, bytes: int = 0, elapsed: float = 0.0) -> None:
+        self.files = files
+        self.bytes = bytes
+        self.elapsed = elapsed
+
+    @property
+    def throughput(self) -> float:
+        """bytes per second"""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.bytes / self.elapsed
+
+    def __str__(self) -> str:
+        return "{} files, {:.1f} MB in {:.2f}s ({:.1f} MB/s)".format(
+            self.files, self.bytes / 2**20, self.elapsed, self.throughput / 2**20)
+
+
+class _Progress:
+    def __init__(self, total: int, callback: Optional[Callable[[int, int], None]],
+                 completed: Optional[list]) -> None:
+        self._lock = threading.Lock()
+        self._callback = callback
+        self._completed = completed
+        self.total = total
+        self.files = 0
+        self.bytes = 0
+        self.stop = threading.Event()
+
+    def step(self, task: CopyTask, size: int):
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            done = self.files
+            if task.key is not None and self._completed is not None:
+                self._completed.append(task.key)
+        if self._callback is not None:
+            self._callback(done, self.total)
+
+
+def _commit_step(step: list[CopyTask], progress: _Progress, durable: bool, metrics: Metrics):
+    staged = []
+    try:
+        for task in step:
+            staged.append((task, task.copy(task.src, task.dst)))
+        if durable:
+            with metrics.timer("batch.fsync"):
+                for _, tmp_path in staged:
+                    if tmp_path is not None and not os.path.islink(tmp_path):
+                        fsync_file(tmp_path)
+        with metrics.timer("batch.rename"):
+            for i, (task, tmp_path) in enumerate(staged):
+                if tmp_path is not None:
+                    replace_file(tmp_path, task.dst)
+                    staged[i] = (task, None)
+                progress.step(task, os.path.getsize(task.dst))
+    finally:
+        for _, tmp_path in staged:
+            if tmp_path is not None and os.path.lexists(tmp_path):
+                remove_file(tmp_path)
+    if durable:
+        with metrics.timer("batch.fsync_dir"):
+            for folder in {os.path.dirname(task.dst) for task in step}:
+                fsync_dir(folder)
+
+
+def _run_group(tasks: list[CopyTask], progress: _Progress, cancel: Optional[threading.Event], durable: bool,
+               metrics: Metrics):
+    for folder in {os.path.dirname(task.dst) for task in tasks}:
+        os.makedirs(folder, exist_ok=True)
+    for start in range(0, len(tasks), SYNC_BATCH):
+        if progress.stop.is_set() or (cancel is not None and cancel.is_set()):
+            return
+        try:
+            _commit_step(tasks[start:start + SYNC_BATCH], progress, durable, metrics)
+        except BaseException:
+            progress.stop.set()
+            raise
+
+
+def run_plan(plan: BatchPlan, max_workers: Optional[int] = None,
+             progress: Optional[Callable[[int, int], None]] = None,
+             cancel: Optional[threading.Event] = None, completed: Optional[list] = None,
+             durable: bool = True, metrics: Metrics = NULL_METRICS) -> BatchResult:
+    """
+    Run every shard group of the plan on a bounded thread pool.
+    `progress(done, total)` is called after each file, from worker threads.
+    Setting `cancel` stops every group before its next step and raises Cancelled.
+    The key of each finished task is appended to `completed`, so callers can
+    record what really reached the disk when the batch fails or is cancelled.
+    """
+    state = _Progress(len(plan), progress, completed)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers or default_workers()) as pool:
+        futures = [pool.submit(_run_group, tasks, state, cancel, durable, metrics)
+                   for tasks in plan.groups.values()]
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            metrics.count("files", state.files)
+            metrics.count("bytes", state.bytes)
+    if cancel is not None and cancel.is_set() and state.files < state.total:
+        raise Cancelled(f"Cancelled after {state.files} of {state.total} files")
+    return BatchResult(state.files, state.bytes, time.perf_counter() - start)
@@ -0,0 +1,149 @@
+import hashlib
+import os
+import threading
+import uuid
+from typing import IO, Callable, Optional
+from .deploy import clone_or_copy, link_or_copy, remove_file, replace_file, seal
+from .metrics import NULL_METRICS, Metrics
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def new_hasher():
+    return hashlib.blake2b(digest_size=20)
+
+
+def file_digest(path: str) -> str:
+    hasher = new_hasher()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class BlobStore:
+    """
+    Content addressed store, blobs live in `blob/<digest[:2]>/<digest>` and
+    resource files are hardlinked (or reflinked) to them. Blobs are sealed read-only,
+    a blob is shared by every resource and game file linked to it.
+
+    Refcounts are never stored: `refs()` counts the links the durable resource
+    metadata holds, once per session, and link/release keep the counts in step.
+    A crash between a blob and its metadata leaves at worst an unused blob.
+    """
+
+    def __init__(self, root: str, refs: Callable[[], dict[str, int]], metrics: Metrics = NULL_METRICS) -> None:
+        self.root = root
+        self.metrics = metrics
+        self._count_refs = refs
+        self._lock = threading.RLock()
+        self.loaded = os.path.isdir(root)
+        os.makedirs(root, exist_ok=True)
+        # counted on first use, most sessions never import or delete a resource
+        self._loaded_refs: Optional[dict[str, int]] = None
+
+    def refs(self) -> dict[str, int]:
+        """
+        Links to each blob, counted from the resources the first time
+        """
+        if self._loaded_refs is None:
+            with self._lock:
+                if self._loaded_refs is None:
+                    self._loaded_refs = self._count_refs()
+        return self._loaded_refs
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _incref(self, digest: str):
+        with self._lock:
+            refs = self.refs()
+            refs[digest] = refs.get(digest, 0) + 1
+
+    def put_file(self, path: str) -> str:
+        """
+        Store the content of `path` if it is new and return its digest.
+        Outside files are never hardlinked, editing them must not touch the store.
+        """
+        digest = file_digest(path)
+        blob_path = self.blob_path(digest)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            tmp_path = blob_path + ".tmp"
+            clone_or_copy(path, tmp_path)
+            seal(tmp_path)
+            os.replace(tmp_path, blob_path)
+            self.metrics.count("blob.new")
+        else:
+            self.metrics.count("blob.dedup")
+        return digest
+
+    def put_stream(self, stream: IO[bytes]) -> str:
+        """
+        Copy a stream into the store, hashing while copying, and return its digest.
+        Duplicate content is dropped once the digest is known.
+        """
+        hasher = new_hasher()
+        tmp_path = os.path.join(self.root, uuid.uuid4().hex + ".tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                while chunk := stream.read(CHUNK_SIZE):
+                    hasher.update(chunk)
+                    f.write(chunk)
+            digest = hasher.hexdigest()
+            blob_path = self.blob_path(digest)
+            if os.path.exists(blob_path):
+                os.remove(tmp_path)
+                self.metrics.count("blob.dedup")
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                seal(tmp_path)
+                os.replace(tmp_path, blob_path)
+                self.metrics.count("blob.new")
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest
+
+    def link(self, digest: str, dst: str):
+        """
+        Materialize a blob at `dst` and take a reference on it
+        """
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.lexists(dst):
+            remove_file(dst)
+        # counted first, a recount must not find `dst` already
+        self._incref(digest)
+        link_or_copy(self.blob_path(digest), dst)
+
+    def release(self, digest: str):
+        with self._lock:
+            refs = self.refs()
+            count = refs.get(digest, 0) - 1
+            if count > 0:
+                refs[digest] = count
+                return
+            refs.pop(digest, None)
+        try:
+            remove_file(self.blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def adopt(self, path: str) -> str:
+        """
+        Migrate an existing file in place: move its content into the store
+        and turn `path` into a link to the blob. The resource of `path` holds
+        its reference already.
+        """
+        digest = file_digest(path)
+        blob_path = self.blob_path(digest)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            link_or_copy(path, blob_path)
+            seal(blob_path)
+        elif not os.path.samefile(path, blob_path):
+            tmp_path = path + ".tmp"
+            link_or_copy(blob_path, tmp_path)
+            replace_file(tmp_path, path)
+        return digest
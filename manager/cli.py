@@ -0,0 +1,269 @@
+"""
+Headless command line, `python -m manager --local DIR [--target DIR] [--install NAME] <command>`.
+Only the manager package is imported, PySimpleGUI and Pillow are never loaded here.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from .backup_store import CODECS
+from .deploy import COPY, STRATEGIES
+from .metrics import NULL_METRICS, Recorder
+from .mod_manager import DEFAULT_TARGET, ModManager
+
+
+def resolve_mod(manager: ModManager, key: str) -> str:
+    """
+    Mods are given by id or by exact name
+    """
+    try:
+        return manager.get_mod(key).id
+    except KeyError:
+        pass
+    for mod in manager.get_mods():
+        if mod.name == key:
+            return mod.id
+    raise SystemExit(f"Unknown mod {key}")
+
+
+def cmd_import(manager: ModManager, args):
+    manager.import_resources(args.source, resource_type=args.type, description=args.description,
+                             shard_only=args.shard_only, max_workers=args.workers)
+
+
+def cmd_create_mods(manager: ModManager, args):
+    """
+    The manifest is a json list of
+    {"name", "description", "resource_ids" | "resource_hashes", "preview"}
+    """
+    with open(args.manifest, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    by_hash = {}
+    for resource in manager.get_resources():
+        by_hash.setdefault(resource.resource_hash, resource.id)
+    for entry in entries:
+        resource_ids = list(entry.get("resource_ids", []))
+        for resource_hash in entry.get("resource_hashes", []):
+            if resource_hash not in by_hash:
+                raise SystemExit(f"Unknown resource_hash {resource_hash} in mod {entry['name']}")
+            resource_ids.append(by_hash[resource_hash])
+        mod_id = manager.add_mod(resource_ids, entry["name"], entry.get("description", ""),
+                                 entry.get("preview"))
+        print(mod_id, entry["name"])
+
+
+def cmd_apply(manager: ModManager, args):
+    for key in args.mods:
+        manager.apply_mod(resolve_mod(manager, key))
+
+
+def cmd_reset(manager: ModManager, args):
+    for key in args.mods:
+        manager.reset_mod(resolve_mod(manager, key))
+
+
+def cmd_deploy(manager: ModManager, args):
+    manager.deploy(resolve_mod(manager, args.mod), args.to)
+
+
+def cmd_targets(manager: ModManager, args):
+    if args.action != "list" and args.name is None:
+        raise SystemExit(f"targets {args.action} needs the name of an install")
+    if args.action == "add":
+        if args.path is None:
+            raise SystemExit("targets add needs a game resource directory")
+        manager.add_target(args.name, args.path)
+    elif args.action == "remove":
+        manager.remove_target(args.name)
+    else:
+        for name, path in manager.get_targets().items():
+            print(name, path, sep="\t")
+
+
+def cmd_priority(manager: ModManager, args):
+    manager.set_priority(resolve_mod(manager, args.mod), args.priority)
+
+
+def cmd_profile(manager: ModManager, args):
+    if args.action != "list" and args.name is None:
+        raise SystemExit(f"profile {args.action} needs the name of a profile")
+    if args.action in ("delete", "switch") and args.name not in manager.get_profiles():
+        raise SystemExit(f"Unknown profile {args.name}")
+    if args.action == "save":
+        manager.save_profile(args.name, [resolve_mod(manager, key) for key in args.mods] or None)
+    elif args.action == "delete":
+        manager.delete_profile(args.name)
+    elif args.action == "list":
+        for name, mod_ids in manager.get_profiles().items():
+            print(name, " ".join(mod_ids), sep="\t")
+    else:
+        plan = manager.plan_profile(args.name)
+        if args.dry_run:
+            print(f"{len(plan.writes)} writes, {len(plan.restores)} restores, "
+                  f"{len(plan.unchanged)} unchanged, {plan.bytes / 2**20:.1f} MB")
+            return
+        manager.switch_profile(args.name, plan=plan)
+
+
+def cmd_list(manager: ModManager, args):
+    if args.kind == "mods":
+        items = [manager.get_mod(mod_id).to_json() for mod_id in manager.search_mods(args.search)]
+    elif args.kind == "stack":
+        items = [manager.get_mod(mod_id).to_json() for mod_id in manager.get_stack()]
+    elif args.kind == "resources":
+        items = [manager.get_resource(resource_id).to_json() for resource_id in manager.search_resources(args.search)]
+    else:
+        items = [record.to_json() for record in manager.get_records()]
+    if args.json:
+        json.dump(items, sys.stdout, ensure_ascii=False)
+        print()
+        return
+    for item in items:
+        print("\t".join(str(value) for key, value in item.items() if key != "resource_ids"))
+
+
+def cmd_export(manager: ModManager, args):
+    data = manager.export_data()
+    if args.output == "-":
+        json.dump(data, sys.stdout, ensure_ascii=False, indent=4)
+        print()
+        return
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+
+
+def cmd_verify(manager: ModManager, args):
+    report = manager.verify(repair=args.repair)
+    if not report.clean and not args.repair:
+        sys.exit(1)
+
+
+def cmd_watch(manager: ModManager, args):
+    """
+    Keep the applied mods on top of game updates until interrupted
+    """
+    watcher = manager.watch(poll=args.poll)
+    print(f"Watching {manager.get_targets()[manager.target]} with {type(watcher).__name__}, Ctrl+C to stop.")
+    try:
+        while True:
+            watcher.wait(args.interval)
+            # let the game finish a burst of writes before checking
+            time.sleep(args.settle)
+            manager.sync(repair=not args.no_repair)
+    except KeyboardInterrupt:
+        pass
+
+
+def cmd_backups(manager: ModManager, args):
+    stats = manager.resource_manager.backup_stats()
+    saved = 1 - stats["stored_bytes"] / stats["bytes"] if stats["bytes"] else 0
+    print(f"{stats['backups']} backups, {stats['bytes'] / 2**20:.1f} MB in {stats['objects']} objects "
+          f"taking {stats['stored_bytes'] / 2**20:.1f} MB ({saved:.0%} saved), {stats['snapshot']} from the snapshot")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m manager", description="MD Mod Manager without GUI")
+    parser.add_argument("--local", required=True, help="local resource directory")
+    parser.add_argument("--target", default=None, help="game resource directory of the install, remembered")
+    parser.add_argument("--install", default=DEFAULT_TARGET, help="name of the install the commands work on")
+    parser.add_argument("--strategy", choices=STRATEGIES, default=COPY, help="how files are deployed")
+    parser.add_argument("--backup-codec", choices=CODECS, default=None, help="compression of new backups")
+    parser.add_argument("--snapshot", default=None,
+                        help="pristine xx/<hash> copy of the game resources, backups identical to it are not stored")
+    parser.add_argument("--metrics", default=None, help="write timings and counters as Prometheus text to this file")
+    parser.add_argument("--metrics-log", default=None, help="append one json line per operation to this file")
+    parser.add_argument("--profile", default=None, help="dump a cProfile of each operation into this directory")
+    parser.add_argument("--trace-memory", action="store_true", help="log the peak memory of each operation")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("import", help="import every file of a directory tree or archive as a resource")
+    command.add_argument("source", help="directory, zip, tar or 7z archive")
+    command.add_argument("--type", default="")
+    command.add_argument("--description", default="")
+    command.add_argument("--shard-only", action="store_true", help="only import files in xx/<hash> folders")
+    command.add_argument("--workers", type=int, default=None)
+    command.set_defaults(func=cmd_import)
+
+    command = commands.add_parser("create-mods", help="create mods from a json manifest")
+    command.add_argument("manifest")
+    command.set_defaults(func=cmd_create_mods)
+
+    command = commands.add_parser("apply", help="apply mods, by id or name")
+    command.add_argument("mods", nargs="+")
+    command.set_defaults(func=cmd_apply)
+
+    command = commands.add_parser("reset", help="reset mods, by id or name")
+    command.add_argument("mods", nargs="+")
+    command.set_defaults(func=cmd_reset)
+
+    command = commands.add_parser("deploy", help="apply a mod to several installs at once")
+    command.add_argument("mod")
+    command.add_argument("--to", nargs="+", required=True, metavar="INSTALL")
+    command.set_defaults(func=cmd_deploy)
+
+    command = commands.add_parser("targets", help="add, remove or list the installs of this library")
+    command.add_argument("action", choices=("add", "remove", "list"))
+    command.add_argument("name", nargs="?")
+    command.add_argument("path", nargs="?", help="for add, the game resource directory")
+    command.set_defaults(func=cmd_targets)
+
+    command = commands.add_parser("priority", help="set the priority of a mod, higher wins conflicts")
+    command.add_argument("mod")
+    command.add_argument("priority", type=int)
+    command.set_defaults(func=cmd_priority)
+
+    command = commands.add_parser("profile", help="save, list, delete or switch to a named set of mods")
+    command.add_argument("action", choices=("save", "list", "delete", "switch"))
+    command.add_argument("name", nargs="?")
+    command.add_argument("mods", nargs="*", help="for save, the applied mods by default")
+    command.add_argument("--dry-run", action="store_true", help="for switch, only print the planned I/O")
+    command.set_defaults(func=cmd_profile)
+
+    command = commands.add_parser("list", help="list mods, resources, records or the applied stack")
+    command.add_argument("kind", choices=("mods", "resources", "records", "stack"))
+    command.add_argument("--search", default="", help="for mods and resources, only those matching these words")
+    command.add_argument("--json", action="store_true")
+    command.set_defaults(func=cmd_list)
+
+    command = commands.add_parser("export", help="export the whole state as json")
+    command.add_argument("output", nargs="?", default="-")
+    command.set_defaults(func=cmd_export)
+
+    command = commands.add_parser("verify", help="check deployed files and backups for drift")
+    command.add_argument("--repair", action="store_true")
+    command.set_defaults(func=cmd_verify)
+
+    command = commands.add_parser("watch", help="re-apply mods over game files the game patches, until Ctrl+C")
+    command.add_argument("--interval", type=float, default=2.0, help="seconds between polls")
+    command.add_argument("--settle", type=float, default=0.5, help="seconds to wait after a change before checking")
+    command.add_argument("--poll", action="store_true", help="poll file stats even where inotify is available")
+    command.add_argument("--no-repair", action="store_true", help="only report changed files")
+    command.set_defaults(func=cmd_watch)
+
+    command = commands.add_parser("backups", help="show how much space the backups take")
+    command.set_defaults(func=cmd_backups)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    os.makedirs(args.local, exist_ok=True)
+    metrics = NULL_METRICS
+    if args.metrics or args.metrics_log or args.profile or args.trace_memory:
+        metrics = Recorder(log_path=args.metrics_log, profile_dir=args.profile, trace_memory=args.trace_memory)
+    try:
+        with ModManager(local_path=args.local, target_path=args.target, deploy_strategy=args.strategy,
+                        backup_codec=args.backup_codec, snapshot_path=args.snapshot, metrics=metrics,
+                        target=args.install) as manager:
+            args.func(manager, args)
+    except ValueError as e:
+        # refused operations, like one on an install that is not registered yet
+        raise SystemExit(str(e))
+    finally:
+        if args.metrics:
+            metrics.write_prometheus(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
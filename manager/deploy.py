@@ -0,0 +1,256 @@
+import errno
+import os
+import shutil
+import stat
+import threading
+import uuid
+from typing import Callable, Optional
+
+# from linux/fs.h, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def reflink(src: str, dst: str):
+    """
+    Clone `src` to `dst` sharing extents (btrfs/xfs), raise OSError if unsupported
+    """
+    import fcntl
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def clone_or_copy(src: str, dst: str):
+    """
+    Reflink if the volume supports it, plain copy otherwise
+    """
+    try:
+        reflink(src, dst)
+        return
+    except (OSError, ImportError):
+        pass
+    shutil.copyfile(src, dst)
+
+
+def link_or_copy(src: str, dst: str):
+    """
+    Hardlink, then reflink, then plain copy, whatever the volume supports first
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    clone_or_copy(src, dst)
+
+
+# a file linked into the game directory must not be writable, or a game patch
+# written in place would go through into the library and every other target
+WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+
+def seal(path: str):
+    """
+    Drop the write bits of `path`, links to it keep its content
+    """
+    mode = os.stat(path).st_mode
+    if mode & WRITE_BITS:
+        os.chmod(path, stat.S_IMODE(mode) & ~WRITE_BITS)
+
+
+def _unseal_on_windows(path: str) -> bool:
+    # Windows refuses to delete or replace a read-only file, POSIX only looks at the directory
+    if os.name != "nt" or not os.path.exists(path):
+        return False
+    os.chmod(path, stat.S_IWRITE)
+    return True
+
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except PermissionError:
+        if not _unseal_on_windows(path):
+            raise
+        os.remove(path)
+
+
+def replace_file(src: str, dst: str):
+    try:
+        os.replace(src, dst)
+    except PermissionError:
+        if not _unseal_on_windows(dst):
+            raise
+        os.replace(src, dst)
+
+
+COPY = "copy"
+HARDLINK = "hardlink"
+REFLINK = "reflink"
+SYMLINK = "symlink"
+STRATEGIES = (COPY, HARDLINK, REFLINK, SYMLINK)
+
+# what to try, in order, when a strategy is not supported between two volumes
+FALLBACKS = {
+    COPY: (COPY,),
+    HARDLINK: (HARDLINK, REFLINK, COPY),
+    REFLINK: (REFLINK, COPY),
+    SYMLINK: (SYMLINK, REFLINK, COPY),
+}
+
+
+# staged files sit next to their destination until they are renamed over it
+STAGING_SUFFIX = ".mdtmp"
+
+
+def staging_path(dst: str) -> str:
+    return "{}.{}{}".format(dst, uuid.uuid4().hex[:8], STAGING_SUFFIX)
+
+
+def _stage(strategy: str, src: str, dst: str, copy: Callable[[str, str], None] = shutil.copyfile) -> str:
+    # never write through an existing dst, it may be a link into the store
+    tmp_path = staging_path(dst)
+    if strategy == HARDLINK:
+        seal(src)
+        os.link(src, tmp_path)
+    elif strategy == REFLINK:
+        reflink(src, tmp_path)
+    elif strategy == SYMLINK:
+        seal(src)
+        os.symlink(os.path.abspath(src), tmp_path)
+    else:
+        copy(src, tmp_path)
+    return tmp_path
+
+
+# sources up to this size are kept in memory for the other targets of a deploy
+SHARED_FILE_LIMIT = 32 * 2**20
+SHARED_READ_LIMIT = 256 * 2**20
+
+
+class SharedReads:
+    """
+    Copy sources read once for several targets. `readers` maps a source to how many
+    copies of it are planned, the first copy keeps the content in memory until the
+    others took it, within SHARED_READ_LIMIT bytes. Bigger files, and any source once
+    the limit is reached, are copied from disk by each reader.
+    """
+
+    def __init__(self, readers: dict[str, int], limit: int = SHARED_READ_LIMIT) -> None:
+        self._readers = dict(readers)
+        self._limit = limit
+        self._cache: dict[str, bytes] = {}
+        self._loading: dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self._bytes = 0
+        # sources read from disk, for metrics and tests
+        self.reads = 0
+
+    def _take(self, src: str) -> Optional[bytes]:
+        # a reader is done with src, the last one drops it
+        with self._lock:
+            self._readers[src] = self._readers.get(src, 1) - 1
+            data = self._cache.get(src)
+            if data is not None and self._readers[src] <= 0:
+                del self._cache[src]
+                self._bytes -= len(data)
+            return data
+
+    def read(self, src: str) -> Optional[bytes]:
+        """
+        The content of src, None when it is not shared and has to be copied from disk
+        """
+        with self._lock:
+            loading = self._loading.get(src)
+            owner = loading is None and src not in self._cache and self._readers.get(src, 1) > 1
+            if owner:
+                loading = self._loading[src] = threading.Event()
+        if owner:
+            data = None
+            try:
+                if os.path.getsize(src) <= SHARED_FILE_LIMIT:
+                    with open(src, "rb") as f:
+                        data = f.read()
+            finally:
+                with self._lock:
+                    del self._loading[src]
+                    self.reads += data is not None
+                    self._readers[src] -= 1
+                    if data is not None and self._readers[src] > 0 and self._bytes + len(data) <= self._limit:
+                        self._cache[src] = data
+                        self._bytes += len(data)
+                loading.set()
+            return data
+        if loading is not None:
+            loading.wait()
+        return self._take(src)
+
+    def copy(self, src: str, dst: str):
+        data = self.read(src)
+        if data is None:
+            shutil.copyfile(src, dst)
+            return
+        with open(dst, "wb") as f:
+            f.write(data)
+
+
+class Deployer:
+    """
+    Put files into the game directory with the selected strategy.
+
+    Support is detected per (source volume, target volume) pair on first use:
+    a strategy that fails there is remembered as unsupported and the next one
+    in FALLBACKS is used from then on.
+
+    Hardlinks and symlinks share the library file with the game, so their source is
+    sealed read-only first: a game patching the file in place fails instead of
+    changing the resource for every mod and target using it. Root ignores the mode,
+    verify still reports such a write as a damaged resource.
+    """
+
+    def __init__(self, strategy: str = COPY) -> None:
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown deploy strategy {strategy}")
+        self.strategy = strategy
+        self._devices: dict[str, int] = {}
+        self._unsupported: dict[tuple[int, int], set[str]] = {}
+        self._lock = threading.Lock()
+
+    def _device(self, folder: str) -> int:
+        device = self._devices.get(folder)
+        if device is None:
+            device = os.stat(folder).st_dev
+            self._devices[folder] = device
+        return device
+
+    def stage(self, src: str, dst: str, strategy: Optional[str] = None,
+              copy: Callable[[str, str], None] = shutil.copyfile) -> str:
+        """
+        Put `src` next to `dst` under a staging name, the caller renames it over `dst`.
+        `copy` does the plain copies.
+        """
+        key = (self._device(os.path.dirname(src)),
+               self._device(os.path.dirname(dst)))
+        unsupported = self._unsupported.get(key, ())
+        for name in FALLBACKS[strategy or self.strategy]:
+            if name in unsupported and name != COPY:
+                continue
+            try:
+                return _stage(name, src, dst, copy)
+            except (OSError, ImportError) as e:
+                if name == COPY or getattr(e, "errno", None) == errno.ENOENT:
+                    raise
+                with self._lock:
+                    self._unsupported.setdefault(key, set()).add(name)
+        raise RuntimeError("unreachable")
+
+    def stage_restore(self, src: str, dst: str) -> str:
+        """
+        Like stage, but the source is a backup that must stay pristine,
+        so only strategies without shared writes (reflink, copy) are used
+        """
+        return self.stage(src, dst, REFLINK if self.strategy != COPY else COPY)
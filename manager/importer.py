@@ -0,0 +1,156 @@
+import io
+import os
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, IO, Iterator
+
+if TYPE_CHECKING:
+    import zipfile
+
+# uncompressed bytes of 7z members held in memory at once
+SEVEN_ZIP_BATCH = 64 * 2**20
+
+
+def split_path(path: str) -> list[str]:
+    # archive members always use "/", Windows paths may use either
+    return [part for part in path.replace("\\", "/").split("/") if part]
+
+
+def is_resource_hash(name: str) -> bool:
+    # the first two characters name the shard directory in the game directory
+    return len(name) >= 2 and not name.startswith(".")
+
+
+def importable(path: str) -> bool:
+    """
+    False for files of a pack which can not be resources, like `.DS_Store` or `__MACOSX/._x`
+    """
+    parts = split_path(path)
+    return bool(parts) and is_resource_hash(parts[-1])
+
+
+def resource_hash_of(path: str) -> str:
+    parts = split_path(path)
+    resource_hash = parts[-1] if parts else ""
+    if not is_resource_hash(resource_hash):
+        raise ValueError(f"Can not import {path}: {resource_hash} is not a resource hash")
+    return resource_hash
+
+
+def in_shard(path: str) -> bool:
+    """
+    True for the `xx/<hash>` layout of the game resource directory
+    """
+    parts = split_path(path)
+    return len(parts) >= 2 and parts[-2] == parts[-1][:2]
+
+
+class ImportEntry:
+    __slots__ = ("path", "resource_hash", "open")
+
+    def __init__(self, path: str, open: Callable[[], IO[bytes]]) -> None:
+        self.path = path
+        self.resource_hash = resource_hash_of(path)
+        # returns a fresh binary stream of the entry, may be called from any thread
+        self.open = open
+
+
+def _file_opener(path: str):
+    return lambda: open(path, "rb")
+
+
+def _scan_directory(root: str) -> list[ImportEntry]:
+    entries = []
+    for folder, _, files in os.walk(root):
+        for filename in sorted(files):
+            path = os.path.join(folder, filename)
+            if not importable(filename):
+                continue
+            entries.append(ImportEntry(os.path.relpath(path, root), _file_opener(path)))
+    return entries
+
+
+def _zip_opener(archive: "zipfile.ZipFile", name: str):
+    return lambda: archive.open(name)
+
+
+class _SevenZipBatches:
+    """
+    py7zr decompresses into memory, still no temporary directory. Members are read
+    SEVEN_ZIP_BATCH bytes at a time, so the entries must be opened in order.
+    """
+
+    def __init__(self, archive) -> None:
+        self._archive = archive
+        self.batches: list[list[str]] = []
+        # a member larger than a batch is read alone
+        self._largest = 0
+        size = 0
+        for info in archive.list():
+            if info.is_directory or not importable(info.filename):
+                continue
+            if not self.batches or (size + info.uncompressed > SEVEN_ZIP_BATCH and size):
+                self.batches.append([])
+                size = 0
+            self.batches[-1].append(info.filename)
+            size += info.uncompressed
+            self._largest = max(self._largest, info.uncompressed)
+        self._current = -1
+        self._members = {}
+
+    def open(self, batch: int, name: str) -> IO[bytes]:
+        if batch != self._current:
+            # the previous batch goes before the next one is decompressed
+            self._members = {}
+            self._members = self._read(self.batches[batch])
+            self._current = batch
+        return self._members.pop(name)
+
+    def _read(self, names: list[str]) -> dict[str, IO[bytes]]:
+        self._archive.reset()
+        if hasattr(self._archive, "read"):
+            # py7zr before 1.0
+            return self._archive.read(names)
+        from py7zr.io import BytesIOFactory
+        factory = BytesIOFactory(self._largest + 1)
+        self._archive.extract(targets=names, factory=factory)
+        members = {}
+        for name in names:
+            product = factory.get(name)
+            product.seek(0)
+            members[name] = io.BytesIO(product.read())
+        return members
+
+
+def _scan_7z(archive) -> list[ImportEntry]:
+    members = _SevenZipBatches(archive)
+    return [ImportEntry(name, (lambda batch, name: lambda: members.open(batch, name))(batch, name))
+            for batch, names in enumerate(members.batches) for name in names]
+
+
+@contextmanager
+def scan(source: str) -> Iterator[tuple[list[ImportEntry], bool]]:
+    """
+    List the files of a directory tree, a zip, a tar(.gz/.bz2/.xz) or a 7z archive.
+    Yields (entries, parallel), tar and 7z members can only be streamed in order
+    so they must not be read in parallel. Files which can not be resources are skipped.
+    """
+    # only an import needs the archive modules
+    import tarfile
+    import zipfile
+    if os.path.isdir(source):
+        yield _scan_directory(source), True
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            yield [ImportEntry(info.filename, _zip_opener(archive, info.filename))
+                   for info in archive.infolist() if not info.is_dir() and importable(info.filename)], True
+    elif tarfile.is_tarfile(source):
+        with tarfile.open(source, "r:*") as archive:
+            members = [member for member in archive.getmembers() if member.isfile() and importable(member.name)]
+            yield [ImportEntry(member.name, (lambda member: lambda: archive.extractfile(member))(member))
+                   for member in members], False
+    elif source.lower().endswith(".7z"):
+        import py7zr
+        with py7zr.SevenZipFile(source, "r") as archive:
+            yield _scan_7z(archive), False
+    else:
+        raise ValueError(f"Can not import {source}: not a directory or a supported archive")
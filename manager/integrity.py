@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from .batch import default_workers
+
+CHUNK_SIZE = 1024 * 1024
+
+try:
+    import xxhash
+
+    def new_fast_hasher():
+        return xxhash.xxh3_128()
+except ImportError:
+    try:
+        import blake3
+
+        def new_fast_hasher():
+            return blake3.blake3()
+    except ImportError:
+        def new_fast_hasher():
+            return hashlib.blake2b(digest_size=16)
+
+
+def fast_digest(path: str) -> str:
+    """
+    Non-cryptographic when xxhash/blake3 is installed, only used to detect drift
+    and to find duplicate backups
+    """
+    hasher = new_fast_hasher()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+OK = "ok"
+DRIFTED = "drifted"
+MISSING = "missing"
+
+# manifest kinds, backups check themselves in the backup store
+DEPLOYED = "deployed"
+
+
+class Manifest:
+    """
+    (size, mtime_ns, digest, source) of every game file we wrote, keyed by resource_hash.
+    The digest is the fast digest of the content we put there, taken when the file
+    was staged.
+    The stat follows symlinks: a symlinked game file changes when its target does.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.RLock()
+        # read on first use, starting up does not need it
+        self._loaded_entries: Optional[dict[str, dict[str, list]]] = None
+
+    @property
+    def _entries(self) -> dict[str, dict[str, list]]:
+        if self._loaded_entries is None:
+            with self._lock:
+                if self._loaded_entries is None:
+                    entries = {DEPLOYED: {}}
+                    try:
+                        with open(self.path, "r", encoding="utf-8") as f:
+                            entries[DEPLOYED] = json.load(f).get(DEPLOYED, {})
+                    except (FileNotFoundError, json.JSONDecodeError):
+                        pass
+                    self._loaded_entries = entries
+        return self._loaded_entries
+
+    def save(self):
+        if self._loaded_entries is None:
+            return
+        tmp_path = self.path + ".tmp"
+        with self._lock:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f)
+        os.replace(tmp_path, self.path)
+
+    def track(self, kind: str, resource_hash: str, path: str, source: str, digest: Optional[str] = None):
+        st = os.stat(path)
+        with self._lock:
+            self._entries[kind][resource_hash] = [st.st_size, st.st_mtime_ns, digest, source]
+
+    def get(self, kind: str, resource_hash: str) -> Optional[list]:
+        return self._entries[kind].get(resource_hash)
+
+    def drop(self, kind: str, resource_hash: str):
+        with self._lock:
+            self._entries[kind].pop(resource_hash, None)
+
+    def keys(self, kind: str) -> list[str]:
+        return list(self._entries[kind])
+
+    def clear(self):
+        with self._lock:
+            self._loaded_entries = {DEPLOYED: {}}
+
+    def check(self, kind: str, resource_hash: str, path: str, source: Optional[str] = None,
+              digest: Optional[str] = None) -> str:
+        """
+        Compare `path` with what was recorded, stat first and hash only when the stat differs.
+        The expected content is `digest` if given, else the recorded one. Without an entry
+        it is the one of `source`, without a source as well the file is expected to match.
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return MISSING
+        entry = self.get(kind, resource_hash)
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return OK
+        if entry is not None:
+            expected = digest or entry[2]
+        elif digest is not None:
+            expected = digest
+        elif source is None:
+            return OK
+        else:
+            # a game file the first version wrote, before there was a manifest
+            try:
+                expected = fast_digest(source)
+            except FileNotFoundError:
+                return DRIFTED
+        if fast_digest(path) != expected:
+            return DRIFTED
+        # same content, only touched: refresh the stat so the next check is cheap
+        with self._lock:
+            self._entries[kind][resource_hash] = [st.st_size, st.st_mtime_ns, expected,
+                                                  entry[3] if entry is not None else source]
+        return OK
+
+
+class VerifyReport:
+    def __init__(self) -> None:
+        self.checked = 0
+        # game files owned by an applied mod which no longer hold the mod content
+        self.clobbered: list[str] = []
+        # game files not owned by any mod which no longer match their backup
+        self.stale_backups: list[str] = []
+        # owned game files which are gone
+        self.missing: list[str] = []
+        # backups whose stored copy changed or vanished since they were taken
+        self.damaged_backups: list[str] = []
+        # clobbered game files linked to their library resource, which changed with them
+        self.damaged_resources: list[str] = []
+
+    @property
+    def clean(self) -> bool:
+        return not (self.clobbered or self.stale_backups or self.missing or self.damaged_backups
+                    or self.damaged_resources)
+
+    def __str__(self) -> str:
+        text = "{} checked, {} clobbered, {} stale backups, {} missing, {} damaged backups".format(
+            self.checked, len(self.clobbered), len(self.stale_backups), len(self.missing), len(self.damaged_backups))
+        if self.damaged_resources:
+            text += ", {} damaged resources".format(len(self.damaged_resources))
+        return text
+
+
+def _same_file(path: str, other: str) -> bool:
+    try:
+        return os.path.samefile(path, other)
+    except OSError:
+        return False
+
+
+def verify(manifest: Manifest, hashes: set[str], owned: dict[str, str], game_path, resource_path,
+           backup_check, backup_digest, max_workers: Optional[int] = None) -> VerifyReport:
+    """
+    Check the game files and backups of `hashes` in parallel.
+    `owned` maps resource_hash -> resource_id currently deployed there, the
+    path helpers map a resource_hash (and resource_id) to a file.
+    `backup_check` gives the state of the backup of a resource_hash (None without one)
+    and `backup_digest` the fast digest of its content.
+    """
+    report = VerifyReport()
+    lock = threading.Lock()
+
+    def check(resource_hash: str):
+        resource_id = owned.get(resource_hash)
+        if resource_id is not None:
+            path = game_path(resource_hash)
+            source = resource_path(resource_id, resource_hash)
+            state = manifest.check(DEPLOYED, resource_hash, path, source)
+            bucket = {DRIFTED: report.clobbered, MISSING: report.missing}.get(state)
+            if state == DRIFTED and _same_file(path, source):
+                # written through a hardlink or symlink, the library copy is gone as well
+                bucket = report.damaged_resources
+        else:
+            state = manifest.check(DEPLOYED, resource_hash, game_path(resource_hash),
+                                   digest=backup_digest(resource_hash))
+            bucket = report.stale_backups if state == DRIFTED else None
+        backup_state = backup_check(resource_hash)
+        with lock:
+            report.checked += 1
+            if bucket is not None:
+                bucket.append(resource_hash)
+            if backup_state not in (None, OK):
+                report.damaged_backups.append(resource_hash)
+
+    with ThreadPoolExecutor(max_workers=max_workers or default_workers()) as pool:
+        list(pool.map(check, hashes))
+    return report
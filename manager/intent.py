@@ -0,0 +1,45 @@
+import json
+import os
+import uuid
+from typing import Optional
+from .batch import fsync_dir
+
+
+class IntentLog:
+    """
+    Write-ahead intent of the running batch: its id and the resource_hash of every
+    game file it may touch.
+
+    It is written and fsynced before the first file is staged and removed after the
+    records are journaled. The journal op committing the batch carries the same id,
+    so on the next start a left over intent is either committed (its id is the last
+    journaled one) or its files get the winners of the journaled state again.
+    """
+
+    def __init__(self, local_path: str) -> None:
+        self.local_path = local_path
+        self.path = os.path.join(local_path, "intent.json")
+
+    def begin(self, files: list[str]) -> str:
+        txn = uuid.uuid4().hex
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"txn": txn, "files": files}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        fsync_dir(self.local_path)
+        return txn
+
+    def pending(self) -> Optional[dict]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def end(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
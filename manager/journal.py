@@ -0,0 +1,163 @@
+import json
+import os
+import pickle
+import threading
+from functools import partial
+from typing import Callable, Optional
+
+SNAPSHOT_MAGIC = b"MDSNAP\x01\n"
+
+
+class LazyDict(dict):
+    """
+    A dict whose missing keys are filled by `loaders[key]()` the first time they are
+    read, so a big value costs nothing until somebody needs it
+    """
+
+    def __init__(self, loaders: dict[str, Callable[[], object]], **values) -> None:
+        super().__init__(values)
+        self._loaders = loaders
+        self._lock = threading.RLock()
+
+    def __missing__(self, key):
+        with self._lock:
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+            value = self._loaders[key]()
+            self[key] = value
+            del self._loaders[key]
+            return value
+
+    def __contains__(self, key) -> bool:
+        return dict.__contains__(self, key) or key in self._loaders
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def loaded(self, key) -> bool:
+        return dict.__contains__(self, key)
+
+
+class Journal:
+    """
+    Snapshot (`<name>.snapshot`) plus an append-only operation log (`<name>.journal`).
+
+    The snapshot pickles every field on its own and only unpickles a field when it
+    is read. A `data.json` snapshot of an older version is still read once, the
+    next compaction replaces it.
+
+    Every operation is one json line, flushed and fsynced when it is appended,
+    so it survives a crash. Each line carries a sequence number and the snapshot
+    remembers the last one it contains, so a crash between writing a snapshot
+    and truncating the log never replays an operation twice.
+    """
+
+    def __init__(self, local_path: str, compact_every: int = 1000, name: str = "data") -> None:
+        self.snapshot_path = os.path.join(local_path, name + ".snapshot")
+        self.json_path = os.path.join(local_path, name + ".json")
+        self.journal_path = os.path.join(local_path, name + ".journal")
+        self.compact_every = compact_every
+        self.seq = 0
+        self.pending = 0
+        self._file = None
+        # pickled fields of the current snapshot, reused for fields nobody decoded
+        self._fields: dict[str, bytes] = {}
+
+    def load(self) -> tuple[Optional[dict], list[dict]]:
+        """
+        Return the snapshot (None if there is none) and the operations after it
+        """
+        snapshot = self._load_snapshot()
+        if snapshot is not None:
+            self.seq = snapshot.get("seq", 0)
+        ops = []
+        valid_size = 0
+        try:
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    # torn write at the tail, drop it. A line which parses but lacks its
+                    # newline is torn too, the next append would run into it
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        break
+                    valid_size += len(line)
+                    if op["seq"] > self.seq:
+                        ops.append(op)
+                        self.seq = op["seq"]
+            if valid_size != os.path.getsize(self.journal_path):
+                os.truncate(self.journal_path, valid_size)
+        except FileNotFoundError:
+            pass
+        self.pending = len(ops)
+        return snapshot, ops
+
+    def _load_snapshot(self) -> Optional[dict]:
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            try:
+                with open(self.json_path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                return None
+        if not content.startswith(SNAPSHOT_MAGIC):
+            raise ValueError(f"{self.snapshot_path} is not a snapshot")
+        fields = self._fields = pickle.loads(memoryview(content)[len(SNAPSHOT_MAGIC):])
+        return LazyDict({key: partial(pickle.loads, value) for key, value in fields.items()})
+
+    def raw(self, key: str) -> bytes:
+        """
+        A field of the current snapshot still pickled, to write it again untouched
+        """
+        return self._fields[key]
+
+    def append(self, *ops: dict):
+        """
+        Durably append operations, several ops are written with a single fsync
+        """
+        if self._file is None:
+            self._file = open(self.journal_path, "ab")
+        lines = []
+        for op in ops:
+            self.seq += 1
+            op["seq"] = self.seq
+            lines.append(json.dumps(op, ensure_ascii=False).encode("utf-8") + b"\n")
+        self._file.write(b"".join(lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.pending += len(ops)
+
+    def need_compact(self) -> bool:
+        return self.pending >= self.compact_every
+
+    def compact(self, snapshot: dict):
+        """
+        Write a new snapshot atomically and start an empty log.
+        Fields given as bytes are taken as already pickled.
+        """
+        snapshot["seq"] = self.seq
+        fields = {key: value if isinstance(value, bytes) else pickle.dumps(value, protocol=5)
+                  for key, value in snapshot.items()}
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            pickle.dump(fields, f, protocol=5)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self._fields = fields
+        if os.path.exists(self.json_path):
+            os.remove(self.json_path)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.journal_path, "wb")
+        self.pending = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
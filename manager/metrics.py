@@ -0,0 +1,225 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import nullcontext
+from functools import wraps
+from typing import Optional
+
+_NULL = nullcontext()
+
+
+class Metrics:
+    """
+    Instrumentation hooks, this base class ignores everything and is the default.
+    Hot paths call `timer`/`count` unconditionally and guard extra work (like a stat
+    for the byte count) with `enabled`, so a disabled recorder costs a method call.
+    """
+    enabled = False
+
+    def operation(self, name: str):
+        """
+        Context of one public ModManager/ResourceManager operation
+        """
+        return _NULL
+
+    def timer(self, name: str):
+        """
+        Context adding its wall time to the timing `name`, may be used from any thread
+        """
+        return _NULL
+
+    def count(self, name: str, value: float = 1):
+        pass
+
+
+NULL_METRICS = Metrics()
+
+
+def instrumented(fn):
+    """
+    Run a method as an operation of `self.metrics`
+    """
+    @wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        with self.metrics.operation(fn.__name__):
+            return fn(self, *args, **kwargs)
+    return wrapper
+
+
+class _Timer:
+    __slots__ = ("_recorder", "_name", "_start")
+
+    def __init__(self, recorder: "Recorder", name: str) -> None:
+        self._recorder = recorder
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._recorder.observe(self._name, time.perf_counter() - self._start)
+
+
+class _Operation:
+    def __init__(self, recorder: "Recorder", name: str) -> None:
+        self._recorder = recorder
+        self._name = name
+        self._outer = False
+        self._profiler = None
+
+    def __enter__(self):
+        recorder = self._recorder
+        local = recorder._local
+        # nested operations (a rollback inside a switch) only add their timing
+        self._outer = getattr(local, "depth", 0) == 0
+        local.depth = getattr(local, "depth", 0) + 1
+        if self._outer:
+            with recorder._lock:
+                self._counters = dict(recorder.counters)
+                self._timings = {name: timing[1] for name, timing in recorder.timings.items()}
+            self._profiler = recorder._start_capture()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        recorder = self._recorder
+        elapsed = time.perf_counter() - self._start
+        recorder.observe("op." + self._name, elapsed)
+        recorder._local.depth -= 1
+        if not self._outer:
+            return
+        with recorder._lock:
+            entry = {"op": self._name, "time": time.time(), "seconds": elapsed,
+                     "error": None if exc_type is None else exc_type.__name__,
+                     "counters": {name: value - self._counters.get(name, 0)
+                                  for name, value in recorder.counters.items()
+                                  if value != self._counters.get(name, 0)},
+                     "timings": {name: timing[1] - self._timings.get(name, 0.0)
+                                 for name, timing in recorder.timings.items()
+                                 if not name.startswith("op.") and timing[1] != self._timings.get(name, 0.0)}}
+        entry.update(recorder._stop_capture(self._name, self._profiler))
+        recorder.log(entry)
+
+
+class Recorder(Metrics):
+    """
+    Timings (count, total, max seconds) and counters in memory.
+
+    Every outermost operation can also be written as one json line to `log_path`
+    with what it added to each counter and timing, profiled with cProfile into
+    `profile_dir/<op>-<n>.prof` and traced with tracemalloc for its peak memory.
+    Timings of worker threads add up, so they may exceed the operation wall time.
+    """
+    enabled = True
+
+    def __init__(self, log_path: Optional[str] = None, profile_dir: Optional[str] = None,
+                 trace_memory: bool = False) -> None:
+        self.counters: dict[str, float] = {}
+        self.timings: dict[str, list] = {}
+        self.log_path = log_path
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self._lock = threading.Lock()
+        # operation nesting is per thread, the GUI loads previews while a batch runs
+        self._local = threading.local()
+        self._profiles = 0
+        self._profiling = False
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def operation(self, name: str):
+        return _Operation(self, name)
+
+    def timer(self, name: str):
+        return _Timer(self, name)
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                self.timings[name] = [1, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                if seconds > timing[2]:
+                    timing[2] = seconds
+
+    def count(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def _start_capture(self):
+        """
+        Start tracemalloc and, unless another operation is being profiled, a profiler
+        """
+        profiler = None
+        if self.profile_dir is not None:
+            import cProfile
+            with self._lock:
+                if not self._profiling:
+                    self._profiling = True
+                    profiler = cProfile.Profile()
+            if profiler is not None:
+                profiler.enable()
+        if self.trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        return profiler
+
+    def _stop_capture(self, name: str, profiler) -> dict:
+        extra = {}
+        if profiler is not None:
+            profiler.disable()
+            with self._lock:
+                self._profiles += 1
+                extra["profile"] = os.path.join(self.profile_dir, f"{name}-{self._profiles}.prof")
+                self._profiling = False
+            profiler.dump_stats(extra["profile"])
+        if self.trace_memory:
+            import tracemalloc
+            extra["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        return extra
+
+    def log(self, entry: dict):
+        if self.log_path is None:
+            return
+        with self._lock:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"counters": dict(self.counters),
+                    "timings": {name: {"count": count, "seconds": total, "max": longest}
+                                for name, (count, total, longest) in self.timings.items()}}
+
+    def prometheus(self, prefix: str = "mdmm") -> str:
+        """
+        The Prometheus text exposition format, for a node_exporter textfile collector
+        """
+        lines = []
+        snapshot = self.snapshot()
+        for name, value in sorted(snapshot["counters"].items()):
+            metric = f"{prefix}_{_metric_name(name)}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        for name, timing in sorted(snapshot["timings"].items()):
+            metric = f"{prefix}_{_metric_name(name)}_seconds"
+            lines += [f"# TYPE {metric} summary", f"{metric}_sum {timing['seconds']}",
+                      f"{metric}_count {timing['count']}",
+                      f"# TYPE {metric}_max gauge", f"{metric}_max {timing['max']}"]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
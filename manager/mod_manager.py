@@ -1,44 +1,73 @@
 from .resource_manager import ResourceManager
-import json
+from .blob_store import file_digest
+from .deploy import COPY, SharedReads
+from .batch import BatchResult
+from .integrity import VerifyReport
+from .importer import in_shard, resource_hash_of, scan
+from .journal import Journal, LazyDict
+from .intent import IntentLog
+from .metrics import NULL_METRICS, Metrics, instrumented
+from .overlay import OverlayPlan, compute_overlay, plan_overlay, winner
+from .search import SearchIndex, tokenize
+from .watcher import Watcher, open_watcher
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Optional
 import os
+import shutil
+import threading
 
 
 class Resource:
-    def __init__(self, id: str, resource_hash: str, name: str, description: str, resource_type: str) -> None:
+    def __init__(self, id: str, resource_hash: str, name: str, description: str, resource_type: str,
+                 digest: Optional[str] = None) -> None:
         self.id = id
         self.resource_hash = resource_hash
         self.name = name
         self.description = description
         self.resource_type = resource_type
+        # content digest in the blob store, None for resources imported before it existed
+        self.digest = digest
 
     def to_json(self):
         return {"id": self.id, "resource_hash": self.resource_hash, "name": self.name, "description": self.description,
-                "resource_type": self.resource_type}
+                "resource_type": self.resource_type, "digest": self.digest}
+
+    def to_row(self) -> tuple:
+        # the order of __init__, Resource(*row) builds it back
+        return self.id, self.resource_hash, self.name, self.description, self.resource_type, self.digest
 
     @staticmethod
     def from_json(data) -> "Resource":
         return Resource(id=data["id"], resource_hash=data["resource_hash"], name=data["name"], description=data["description"],
-                        resource_type=data["resource_type"])
+                        resource_type=data["resource_type"], digest=data.get("digest"))
 
 
 class Mod:
-    def __init__(self, id: str, name: str, description: str, resource_ids: list[str]) -> None:
+    def __init__(self, id: str, name: str, description: str, resource_ids: list[str], priority: int = 0) -> None:
         self.id = id
         self.name = name
         self.description = description
         self.resource_ids = resource_ids
+        # higher priority wins a game file, equal priority: the later applied mod wins
+        self.priority = priority
 
     def to_json(self):
         return {"id": self.id, "name": self.name, "description": self.description,
-                "resource_ids": self.resource_ids}
+                "resource_ids": self.resource_ids, "priority": self.priority}
+
+    def to_row(self) -> tuple:
+        return self.id, self.name, self.description, self.resource_ids, self.priority
 
     @staticmethod
     def from_json(data) -> "Mod":
         return Mod(id=data["id"], name=data["name"], description=data["description"],
-                   resource_ids=data["resource_ids"])
+                   resource_ids=data["resource_ids"], priority=data.get("priority", 0))
 
 
 class Record:
+    __slots__ = ("id", "resource_id")
+
     def __init__(self, id: str, resource_id: str) -> None:
         self.id = id
         self.resource_id = resource_id
@@ -55,39 +84,755 @@ class Record:
             return self.id == o.id and self.resource_id == o.resource_id
         return False
 
+    def __hash__(self) -> int:
+        return hash((self.id, self.resource_id))
+
+
+class RecordStore:
+    """
+    Applied records, indexed by mod, by resource and by game file (resource_hash)
+    so that applying, resetting and conflict lookups never scan every record
+    """
+
+    def __init__(self) -> None:
+        # mod_id -> {resource_id: Record}, in apply order
+        self._by_mod: dict[str, dict[str, Record]] = {}
+        # resource_id -> mod_ids which applied it
+        self._by_resource: dict[str, set[str]] = {}
+        # resource_hash -> records owning that game file, in apply order
+        self._owners: dict[str, list[Record]] = {}
+        # mod_id -> when it was applied, for the stack order
+        self._seq: dict[str, int] = {}
+        self.next_seq = 0
+        self._size = 0
+
+    def add(self, mod_id: str, resource_id: str, resource_hash: str):
+        records = self._by_mod.get(mod_id)
+        if records is None:
+            records = self._by_mod[mod_id] = {}
+            self._seq[mod_id] = self.next_seq
+            self.next_seq += 1
+        if resource_id in records:
+            return
+        record = Record(id=mod_id, resource_id=resource_id)
+        records[resource_id] = record
+        self._by_resource.setdefault(resource_id, set()).add(mod_id)
+        self._owners.setdefault(resource_hash, []).append(record)
+        self._size += 1
+
+    def remove(self, mod_id: str, resource_id: str, resource_hash: str):
+        records = self._by_mod.get(mod_id)
+        record = None if records is None else records.pop(resource_id, None)
+        if record is None:
+            return
+        if not records:
+            del self._by_mod[mod_id]
+            del self._seq[mod_id]
+        mods = self._by_resource[resource_id]
+        mods.discard(mod_id)
+        if not mods:
+            del self._by_resource[resource_id]
+        owners = self._owners.get(resource_hash)
+        if owners is not None and record in owners:
+            owners.remove(record)
+            if not owners:
+                del self._owners[resource_hash]
+        self._size -= 1
+
+    def of_mod(self, mod_id: str) -> list[Record]:
+        return list(self._by_mod.get(mod_id, {}).values())
+
+    def is_applied(self, mod_id: str) -> bool:
+        return mod_id in self._by_mod
+
+    def applied_mods(self) -> list[str]:
+        return list(self._by_mod)
+
+    def seq(self, mod_id: str) -> int:
+        return self._seq.get(mod_id, self.next_seq)
+
+    def mods_of_resource(self, resource_id: str) -> set[str]:
+        return self._by_resource.get(resource_id, set())
+
+    def owners(self, resource_hash: str) -> list[Record]:
+        """
+        Records currently owning a game file, the last one wrote it
+        """
+        return self._owners.get(resource_hash, [])
+
+    def owned(self, rank: Callable[[str], tuple]) -> dict[str, Record]:
+        """
+        resource_hash -> the record whose resource is in the game file now
+        """
+        return {resource_hash: winner(owners, rank) for resource_hash, owners in self._owners.items()}
+
+    def rows(self) -> list[tuple[str, str, str]]:
+        """
+        (mod_id, resource_id, resource_hash) of every record in apply order, add(*row) builds them back
+        """
+        hashes = {record: resource_hash for resource_hash, owners in self._owners.items() for record in owners}
+        return [(record.id, record.resource_id, hashes[record]) for record in self]
+
+    @staticmethod
+    def from_rows(rows) -> "RecordStore":
+        store = RecordStore()
+        for row in rows:
+            store.add(*row)
+        return store
+
+    def __iter__(self):
+        for records in self._by_mod.values():
+            yield from records.values()
+
+    def __len__(self) -> int:
+        return self._size
+
+
+DEFAULT_TARGET = "default"
+# ops of the library journal and the fields each of them needs, a target journal has the records
+LIBRARY_OPS = {"add_resource": ("resource",), "delete_resource": ("id",), "add_mod": ("mod",), "delete_mod": ("id",),
+               "save_profile": ("name", "mod_ids"), "delete_profile": ("name",), "set_priority": ("mod_id", "priority"),
+               "add_target": ("name", "path"), "remove_target": ("name",)}
+
+
+class Target:
+    """
+    One game install sharing the library. Its records and the id of its last batch
+    are journaled in `target.snapshot`/`target.journal` under `state_path`, next to
+    its intent log, backups and manifest, so installs never see each other's state.
+    """
+
+    def __init__(self, name: str, path: str, state_path: str, resource_manager: ResourceManager) -> None:
+        self.name = name
+        self.path = path
+        self.state_path = state_path
+        self.resource_manager = resource_manager
+        self.journal = Journal(state_path, name="target")
+        self.intent = IntentLog(state_path)
+        # records: RecordStore, last_txn: id of the last committed batch
+        self.data: dict = {}
+        # game directory watcher started by watch(), drained by sync()
+        self.watcher: Optional[Watcher] = None
+        # drifted game files a sync left for later
+        self.dirty: set[str] = set()
+
+    @property
+    def records(self) -> RecordStore:
+        return self.data["records"]
+
+    def snapshot(self) -> dict:
+        if isinstance(self.data, LazyDict) and not self.data.loaded("records"):
+            records = self.journal.raw("records")
+        else:
+            records = self.records.rows()
+        return {"records": records, "last_txn": self.data["last_txn"]}
+
+    def save(self):
+        self.journal.compact(self.snapshot())
+
+    def unwatch(self):
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+    def close(self):
+        self.unwatch()
+        self.resource_manager.close()
+        if self.journal.pending:
+            self.save()
+        self.journal.close()
+
 
 class ModManager:
-    def __init__(self, local_path, target_path) -> None:
+    """
+    A library of resources, mods and profiles in `local_path`, deployed to one or
+    more registered targets (game installs). `target` is the one the single-target
+    methods work on, `target_path` (re)registers its game directory. A library
+    without it registered still imports and lists, the single-target methods
+    raise ValueError until it is.
+    """
+
+    def __init__(self, local_path, target_path: Optional[str] = None, deploy_strategy: str = COPY,
+                 durable: bool = True, backup_codec: Optional[str] = None, snapshot_path: Optional[str] = None,
+                 metrics: Metrics = NULL_METRICS, target: str = DEFAULT_TARGET) -> None:
+        # a Recorder collects timings, bytes and cache hits of every operation
+        self.metrics = metrics
         self._local_path = local_path
-        self._target_path = target_path
-        # mods: Dict[str, Mod], resources: Dict[str, Resource], records: list[Record]
+        # ResourceManager options of every target
+        self._options = {"deploy_strategy": deploy_strategy, "durable": durable, "backup_codec": backup_codec,
+                         "snapshot_path": snapshot_path}
+        self._journal = Journal(local_path)
+        # records of a library from before targets, until the default target takes them
+        self._legacy: Optional[dict] = None
+        # mods: Dict[str, Mod], resources: Dict[str, Resource], targets: Dict[str, game directory]
         self._data = self.load_data()
-        self.resource_manager = ResourceManager(
-            local_path=local_path, target_path=target_path)
+        # search indexes of "mods" and "resources", built on the first search
+        self._indexes: dict[str, SearchIndex] = {}
+        # targets opened so far, the others are loaded when first used
+        self._targets: dict[str, Target] = {}
+        # files of the library while no target is open
+        self._library: Optional[ResourceManager] = None
+        self._target_name = target
+        if target_path is not None:
+            self.add_target(target, target_path)
+        # an interrupted batch is finished on startup
+        if target in self._data["targets"]:
+            self._open(target)
 
-    def apply_mod(self, mod_id: str):
+    @property
+    def resource_manager(self) -> ResourceManager:
         """
-        应用mod
+        Files of the current target, of the library alone while it is not registered
         """
-        mod = self._data["mods"][mod_id]
-        for resource_id in mod.resource_ids:
-            self.resource_manager.apply_resource(
-                resource_id, resource_hash=self._data["resources"][resource_id].resource_hash)
-            self._data["records"].append(
-                Record(id=mod_id, resource_id=resource_id))
-        print("Mod applied.")
+        if self._target_name not in self._data["targets"]:
+            return self._library_manager()
+        return self._current().resource_manager
+
+    @property
+    def target(self) -> str:
+        return self._target_name
+
+    def _current(self) -> Target:
+        return self._open(self._target_name)
+
+    def _shared(self) -> Optional[ResourceManager]:
+        target = next(iter(self._targets.values()), None)
+        return target.resource_manager if target is not None else self._library
+
+    def _library_manager(self) -> ResourceManager:
+        if self._library is None:
+            shared = self._shared()
+            self._library = ResourceManager(
+                local_path=self._local_path, target_path=None, metrics=self.metrics,
+                blob_store=shared and shared.blob_store, preview_cache=shared and shared.preview_cache,
+                backup_roots=self._backup_roots, blob_refs=self._blob_refs, **self._options)
+        return self._library
+
+    def _state_path(self, name: str) -> str:
+        # the default target keeps the layout of a library from before targets
+        return self._local_path if name == DEFAULT_TARGET else os.path.join(self._local_path, "targets", name)
+
+    def _backup_roots(self) -> list[str]:
+        # every target keeps its own backup pointers, the objects are shared by the library
+        return [os.path.join(self._state_path(name), "backup") for name in self._data["targets"]]
+
+    def _blob_refs(self) -> dict[str, int]:
+        # every journaled resource holds one link to its blob, resources from before
+        # the blob store have no digest and are hashed
+        refs = {}
+        resource_manager = self._shared()
+        for resource in self._data["resources"].values():
+            digest = resource.digest
+            if digest is None:
+                try:
+                    digest = file_digest(resource_manager.resource_file(resource.id, resource.resource_hash))
+                except FileNotFoundError:
+                    continue
+            refs[digest] = refs.get(digest, 0) + 1
+        return refs
+
+    def _open(self, name: str) -> Target:
+        target = self._targets.get(name)
+        if target is not None:
+            return target
+        path = self._data["targets"].get(name)
+        if path is None:
+            raise ValueError(f"No game directory registered for target {name}, pass its target_path (--target) first")
+        state_path = self._state_path(name)
+        os.makedirs(state_path, exist_ok=True)
+        # every target shares the blob store and previews of the library
+        shared = self._shared()
+        resource_manager = ResourceManager(
+            local_path=self._local_path, target_path=path, state_path=state_path, metrics=self.metrics,
+            blob_store=shared and shared.blob_store, preview_cache=shared and shared.preview_cache,
+            backup_roots=self._backup_roots, blob_refs=self._blob_refs, **self._options)
+        target = Target(name, path, state_path, resource_manager)
+        target.data = self._load_target(target)
+        self._targets[name] = target
+        self._recover(target)
+        return target
 
-    def reset_mod(self, mod_id: str):
+    def _all_targets(self) -> list[Target]:
+        return [self._open(name) for name in self._data["targets"]]
+
+    @staticmethod
+    def _check_target_name(name: str):
+        if not name or name in (".", "..") or os.path.basename(name) != name or "/" in name or "\\" in name:
+            raise ValueError(f"Invalid target name {name}")
+
+    def get_targets(self) -> dict[str, str]:
+        """
+        Registered targets, name -> game directory
+        """
+        return dict(self._data["targets"])
+
+    @instrumented
+    def add_target(self, name: str, path: str):
+        """
+        注册一个游戏目录, 它有自己的记录和备份, 资源库共享.
+        换到另一个目录时旧目录的备份作废, 需要先重置它上面的mod
         """
-        重置mod
+        self._check_target_name(name)
+        old_path = self._data["targets"].get(name)
+        if old_path == path:
+            return
+        if old_path is not None:
+            target = self._open(name)
+            if target.records.applied_mods():
+                raise ValueError(f"Target {name} has applied mods, reset them before moving it")
+            # the originals of the old directory would be restored into the new one
+            target.resource_manager.forget_backups()
+            target.close()
+            del self._targets[name]
+        self._commit({"op": "add_target", "name": name, "path": path})
+
+    @instrumented
+    def remove_target(self, name: str):
         """
+        删除目标和它的备份, 需要先重置它上面的mod
+        """
+        if name == DEFAULT_TARGET or name == self._target_name:
+            raise ValueError(f"Target {name} is in use and can not be removed")
+        target = self._open(name)
+        if target.records.applied_mods():
+            raise ValueError(f"Target {name} has applied mods, reset them first")
+        target.close()
+        del self._targets[name]
+        self._commit({"op": "remove_target", "name": name})
+        shutil.rmtree(target.state_path, ignore_errors=True)
+        # objects only its backups used
+        self.resource_manager.backup_store.gc()
+
+    def use_target(self, name: str):
+        """
+        Switch the target the single-target methods work on
+        """
+        self._open(name)
+        self._target_name = name
+
+    def _begin(self, target: Target, plan: OverlayPlan) -> str:
+        """
+        Write the intent of a batch, every game file it may touch
+        """
+        with self.metrics.timer("intent"):
+            return target.intent.begin(sorted(plan.hashes()))
+
+    def _recover(self, target: Target):
+        """
+        Finish a batch interrupted by a crash: drop its staged files and, if it never
+        committed, put the winners of the journaled records and priorities on the files it touched
+        """
+        intent = target.intent.pending()
+        if intent is None:
+            return
+        target.resource_manager.clean_staging(intent["files"])
+        if intent["txn"] != target.data["last_txn"]:
+            self._rollback(target, intent["files"])
+            print(f"Interrupted operation on {target.name} rolled back.")
+        target.intent.end()
+
+    def _ranker(self, target: Target) -> Callable[[str], tuple[int, int]]:
+        mods = self._data["mods"]
+        records = target.records
+        return lambda mod_id: (mods[mod_id].priority, records.seq(mod_id))
+
+    def get_stack(self) -> list[str]:
+        """
+        Applied mods from the lowest to the highest priority
+        """
+        target = self._current()
+        return sorted(target.records.applied_mods(), key=self._ranker(target))
+
+    def _winner_id(self, candidates, rank) -> Optional[str]:
+        record = winner(candidates, rank)
+        return None if record is None else record.resource_id
+
+    def _plan(self, target: Target, hashes, candidates_after, rank_after) -> OverlayPlan:
+        """
+        Winner of every affected game file before and after the change, before any I/O
+        """
+        records = target.records
+        rank = self._ranker(target)
+        with self.metrics.timer("plan"):
+            return plan_overlay(hashes,
+                                lambda resource_hash: self._winner_id(records.owners(resource_hash), rank),
+                                lambda resource_hash: self._winner_id(candidates_after(resource_hash), rank_after))
+
+    def _plan_apply(self, target: Target, mod_id: str) -> OverlayPlan:
         mod = self._data["mods"][mod_id]
+        records = target.records
+        resources = self._data["resources"]
+        rank = self._ranker(target)
+        new_by_hash = {}
         for resource_id in mod.resource_ids:
-            self.resource_manager.reset_resource(
-                resource_hash=self._data["resources"][resource_id].resource_hash)
-            self._data["records"].remove(
+            new_by_hash.setdefault(resources[resource_id].resource_hash, []).append(
                 Record(id=mod_id, resource_id=resource_id))
-        print("Mod reset.")
+        # a mod applied again moves to the top of its priority
+        top = records.next_seq
+        return self._plan(
+            target, new_by_hash,
+            lambda resource_hash: [record for record in records.owners(resource_hash) if record.id != mod_id]
+            + new_by_hash[resource_hash],
+            lambda the_mod_id: (mod.priority, top) if the_mod_id == mod_id else rank(the_mod_id))
+
+    def _apply(self, target: Target, mod_id: str, plan: OverlayPlan,
+               progress: Optional[Callable[[int, int], None]] = None, cancel: Optional[threading.Event] = None,
+               shared_reads: Optional[SharedReads] = None) -> BatchResult:
+        mod = self._data["mods"][mod_id]
+        records = target.records
+        resources = self._data["resources"]
+        completed = []
+        result = None
+        txn = self._begin(target, plan)
+        try:
+            result = target.resource_manager.apply_overlay(
+                plan.writes, plan.restores, progress=progress, cancel=cancel, completed=completed,
+                shared_reads=shared_reads)
+        finally:
+            # files which needed no I/O are settled as well
+            settled = set(plan.unchanged).union(completed)
+            ops = []
+            if records.is_applied(mod_id):
+                ops.append({"op": "reset_mod", "mod_id": mod_id,
+                            "resource_ids": [record.resource_id for record in records.of_mod(mod_id)]})
+            applied = [resource_id for resource_id in mod.resource_ids
+                       if resources[resource_id].resource_hash in settled]
+            if applied:
+                ops.append({"op": "apply_mod", "mod_id": mod_id, "resource_ids": applied})
+            self._commit_target(target, *ops, txn=txn)
+        return result
+
+    @instrumented
+    def apply_mod(self, mod_id: str, progress: Optional[Callable[[int, int], None]] = None,
+                  cancel: Optional[threading.Event] = None) -> BatchResult:
+        """
+        应用mod, 只写入胜出者改变的游戏文件. 取消或出错时只记录已经生效的资源
+        """
+        target = self._current()
+        result = self._apply(target, mod_id, self._plan_apply(target, mod_id),
+                             progress=progress, cancel=cancel)
+        print("Mod applied.", result)
+        return result
+
+    @instrumented
+    def deploy(self, mod_id: str, targets: list[str], progress: Optional[Callable[[int, int], None]] = None,
+               cancel: Optional[threading.Event] = None) -> dict[str, BatchResult]:
+        """
+        同时把mod应用到多个目标, 每个目标一个批次并行执行, 多个目标都要复制的资源文件只读取一次.
+        每个目标单独提交, 一个目标出错或取消时其它目标已完成的部分照常记录, 之后抛出第一个错误
+        """
+        opened = [self._open(name) for name in dict.fromkeys(targets)]
+        plans = {target.name: self._plan_apply(target, mod_id) for target in opened}
+        readers = {}
+        for target in opened:
+            for resource_id, resource_hash in plans[target.name].writes:
+                src = target.resource_manager.resource_file(resource_id, resource_hash)
+                readers[src] = readers.get(src, 0) + 1
+        shared_reads = SharedReads(readers)
+        counts = {target.name: (0, len(plans[target.name])) for target in opened}
+        lock = threading.Lock()
+
+        def target_progress(name: str, done: int, total: int):
+            with lock:
+                counts[name] = (done, total)
+                done, total = map(sum, zip(*counts.values()))
+            if progress is not None:
+                progress(done, total)
+
+        results = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=len(opened) or 1) as pool:
+            futures = {target.name: pool.submit(self._apply, target, mod_id, plans[target.name],
+                                                partial(target_progress, target.name), cancel, shared_reads)
+                       for target in opened}
+            for name, future in futures.items():
+                try:
+                    results[name] = future.result()
+                except BaseException as e:
+                    error = error or e
+        self.metrics.count("deploy.shared_reads", shared_reads.reads)
+        for name, result in results.items():
+            print(f"Mod applied to {name}.", result)
+        if error is not None:
+            raise error
+        return results
+
+    @instrumented
+    def reset_mod(self, mod_id: str, progress: Optional[Callable[[int, int], None]] = None,
+                  cancel: Optional[threading.Event] = None) -> BatchResult:
+        """
+        重置mod, 仍被其它已应用mod占用的文件改为写入下一层的资源而不是备份
+        """
+        target = self._current()
+        records = target.records
+        resources = self._data["resources"]
+        own = {}
+        for record in records.of_mod(mod_id):
+            own.setdefault(resources[record.resource_id].resource_hash, []).append(record.resource_id)
+        plan = self._plan(
+            target, own,
+            lambda resource_hash: [record for record in records.owners(resource_hash) if record.id != mod_id],
+            self._ranker(target))
+        completed = []
+        result = None
+        txn = self._begin(target, plan)
+        try:
+            result = target.resource_manager.apply_overlay(
+                plan.writes, plan.restores, progress=progress, cancel=cancel, completed=completed)
+        finally:
+            settled = set(plan.unchanged).union(completed)
+            removed = [resource_id for resource_hash, resource_ids in own.items() if resource_hash in settled
+                       for resource_id in resource_ids]
+            self._commit_target(
+                target, *([{"op": "reset_mod", "mod_id": mod_id, "resource_ids": removed}] if removed else []),
+                txn=txn)
+        print("Mod reset.", result)
+        return result
+
+    @instrumented
+    def set_priority(self, mod_id: str, priority: int,
+                     progress: Optional[Callable[[int, int], None]] = None) -> Optional[BatchResult]:
+        """
+        修改mod优先级, 在每个应用了它的目标上只重写胜出者改变的文件, 返回当前目标的结果.
+        出错时恢复原优先级和已重写的文件
+        """
+        mod = self._data["mods"].get(mod_id)
+        if mod is None:
+            raise KeyError(mod_id)
+        old_priority = mod.priority
+        resources = self._data["resources"]
+        # every target writes its intent before the priority is journaled: after a crash
+        # each of them is recovered to the winners of whichever priority reached the journal
+        batches = []
+        for target in self._all_targets():
+            records = target.records
+            if not records.is_applied(mod_id):
+                continue
+            rank = self._ranker(target)
+            hashes = {resources[record.resource_id].resource_hash for record in records.of_mod(mod_id)}
+            plan = self._plan(
+                target, hashes, records.owners,
+                lambda the_mod_id, records=records, rank=rank:
+                    (priority, records.seq(mod_id)) if the_mod_id == mod_id else rank(the_mod_id))
+            batches.append((target, plan, self._begin(target, plan)))
+        self._commit({"op": "set_priority", "mod_id": mod_id, "priority": priority})
+        result = None
+        for i, (target, plan, _) in enumerate(batches):
+            try:
+                batch = target.resource_manager.apply_overlay(
+                    plan.writes, plan.restores, progress=progress if target.name == self._target_name else None)
+            except BaseException:
+                # back to the old priority, then every target it reached to the winners under it
+                self._commit({"op": "set_priority", "mod_id": mod_id, "priority": old_priority})
+                for j, (done_target, done_plan, txn) in enumerate(batches):
+                    if j <= i:
+                        self._rollback(done_target, done_plan.hashes())
+                    self._commit_target(done_target, txn=txn)
+                raise
+            if target.name == self._target_name:
+                result = batch
+        for target, _, txn in batches:
+            self._commit_target(target, {"op": "commit"}, txn=txn)
+        return result
+
+    def get_profiles(self) -> dict[str, list[str]]:
+        return self._data["profiles"]
+
+    @instrumented
+    def save_profile(self, name: str, mod_ids: Optional[list[str]] = None):
+        """
+        保存一组mod为配置, 默认为当前目标已应用的mod
+        """
+        if mod_ids is None:
+            mod_ids = self.get_stack()
+        for mod_id in mod_ids:
+            if mod_id not in self._data["mods"]:
+                raise KeyError(mod_id)
+        self._commit({"op": "save_profile", "name": name, "mod_ids": list(mod_ids)})
+
+    @instrumented
+    def delete_profile(self, name: str):
+        self._commit({"op": "delete_profile", "name": name})
+
+    def _profile_stack(self, name: str) -> list[str]:
+        # profile order breaks priority ties, like apply order does for the stack
+        position = {mod_id: i for i, mod_id in enumerate(self._data["profiles"][name])}
+        return sorted(position, key=lambda mod_id: (self._data["mods"][mod_id].priority, position[mod_id]))
+
+    @instrumented
+    def plan_profile(self, name: str) -> OverlayPlan:
+        """
+        切换配置前计算需要写入的文件, 只包含内容会改变的文件, 附带文件数和字节数
+        """
+        resources = self._data["resources"]
+        current = self._owned(self._current())
+        target = compute_overlay(
+            [(resource_id, resources[resource_id].resource_hash) for resource_id in self._data["mods"][mod_id].resource_ids]
+            for mod_id in self._profile_stack(name))
+        # resources with the same content are the same file for the game
+        plan = plan_overlay(set(current) | set(target), current.get, target.get)
+        writes = []
+        for resource_id, resource_hash in plan.writes:
+            digest = resources[resource_id].digest
+            if digest is not None and resource_hash in current and resources[current[resource_hash]].digest == digest:
+                plan.unchanged.append(resource_hash)
+            else:
+                writes.append((resource_id, resource_hash))
+        plan.writes = writes
+        plan.bytes = self.resource_manager.plan_bytes(plan)
+        return plan
+
+    @instrumented
+    def switch_profile(self, name: str, progress: Optional[Callable[[int, int], None]] = None,
+                       cancel: Optional[threading.Event] = None, plan: Optional[OverlayPlan] = None) -> BatchResult:
+        """
+        切换到配置, 只写入内容改变的文件并复用已有备份.
+        取消或出错时已写入的文件会被恢复, 游戏目录保持切换前的状态.
+        """
+        target = self._current()
+        if plan is None:
+            plan = self.plan_profile(name)
+        print(f"Switching to profile {name}: {len(plan)} files, {plan.bytes / 2**20:.1f} MB.")
+        completed = []
+        txn = self._begin(target, plan)
+        try:
+            result = target.resource_manager.apply_overlay(
+                plan.writes, plan.restores, progress=progress, cancel=cancel, completed=completed)
+        except BaseException:
+            self._rollback(target, completed)
+            self._commit_target(target, txn=txn)
+            raise
+        # stack bookkeeping, no I/O: the profile replaces every applied mod in its own order
+        records = target.records
+        ops = [{"op": "reset_mod", "mod_id": mod_id,
+                "resource_ids": [record.resource_id for record in records.of_mod(mod_id)]}
+               for mod_id in records.applied_mods()]
+        ops += [{"op": "apply_mod", "mod_id": mod_id, "resource_ids": self._data["mods"][mod_id].resource_ids}
+                for mod_id in self._profile_stack(name) if self._data["mods"][mod_id].resource_ids]
+        self._commit_target(target, *ops, txn=txn)
+        print("Profile switched.", result)
+        return result
+
+    def _rollback(self, target: Target, resource_hashes: list[str]):
+        """
+        Put the current winners back on files a failed batch may have changed,
+        original game files only where they were backed up, so where they were changed
+        """
+        records = target.records
+        rank = self._ranker(target)
+        resource_manager = target.resource_manager
+        writes = [(self._winner_id(records.owners(resource_hash), rank), resource_hash)
+                  for resource_hash in resource_hashes]
+        resource_manager.apply_overlay(
+            [(resource_id, resource_hash) for resource_id, resource_hash in writes if resource_id is not None],
+            [resource_hash for resource_id, resource_hash in writes
+             if resource_id is None and resource_manager.has_backup(resource_hash)])
+
+    def _owned(self, target: Target) -> dict[str, str]:
+        return {resource_hash: record.resource_id
+                for resource_hash, record in target.records.owned(self._ranker(target)).items()}
+
+    @instrumented
+    def verify(self, repair: bool = False) -> VerifyReport:
+        """
+        检查游戏文件和备份是否被游戏更新改动, repair=True 时只重新复制改动过的文件
+        """
+        owned = self._owned(self._current())
+        report = self.resource_manager.verify(owned)
+        print("Verified.", report)
+        if repair and not report.clean:
+            result = self.resource_manager.repair(report, owned)
+            print("Repaired.", result)
+        return report
+
+    def watch(self, poll: bool = False) -> Watcher:
+        """
+        监视游戏目录, 之后 sync() 只检查改动过的文件. 没有inotify或 poll=True 时轮询文件状态
+        """
+        target = self._current()
+        if target.watcher is None:
+            target.watcher = open_watcher(target.path, target.resource_manager.tracked, poll=poll)
+        return target.watcher
+
+    def unwatch(self):
+        target = self._targets.get(self._target_name)
+        if target is not None:
+            target.unwatch()
+
+    @instrumented
+    def sync(self, repair: bool = True) -> Optional[VerifyReport]:
+        """
+        只校验监视器发现改动的游戏文件, 没有改动时返回None, 丢失事件时校验全部文件.
+        repair=True 时游戏更新过的文件成为新的备份, 再重新应用占用它的mod; 否则留到下一次sync
+        """
+        target = self._current()
+        if target.watcher is None:
+            raise ValueError("Not watching, call watch() first")
+        changed = target.watcher.changes()
+        if changed is not None:
+            changed |= target.dirty
+            if not changed:
+                return None
+            self.metrics.count("watch.changes", len(changed))
+        owned = self._owned(target)
+        report = self.resource_manager.verify(owned, hashes=changed)
+        target.dirty = set()
+        if report.clean:
+            return report
+        print("Game files changed.", report)
+        if repair:
+            result = self.resource_manager.repair(report, owned)
+            print("Repaired.", result)
+        else:
+            target.dirty.update(report.clobbered, report.stale_backups, report.missing, report.damaged_backups,
+                                report.damaged_resources)
+        return report
+
+    def _index(self, kind: str) -> SearchIndex:
+        index = self._indexes.get(kind)
+        if index is None:
+            index = self._indexes[kind] = SearchIndex()
+            if kind == "mods":
+                index.update((mod.id, mod.name, mod.description) for mod in self._data["mods"].values())
+            else:
+                index.update((resource.id, resource.name, resource.description, resource.resource_type)
+                             for resource in self._data["resources"].values())
+        return index
+
+    def _index_op(self, op: dict):
+        # keep built indexes in step with _data, one id per op
+        kind = op["op"]
+        if kind == "add_resource" and "resources" in self._indexes:
+            resource = op["resource"]
+            self._indexes["resources"].add(
+                resource["id"], resource["name"], resource["description"], resource["resource_type"])
+        elif kind == "delete_resource" and "resources" in self._indexes:
+            self._indexes["resources"].remove(op["id"])
+        elif kind == "add_mod" and "mods" in self._indexes:
+            mod = op["mod"]
+            self._indexes["mods"].add(mod["id"], mod["name"], mod["description"])
+        elif kind == "delete_mod" and "mods" in self._indexes:
+            self._indexes["mods"].remove(op["id"])
+
+    def _search(self, kind: str, query: str) -> list[str]:
+        # listing everything needs no index, it is built on the first real query
+        if kind not in self._indexes and not tokenize(query):
+            return list(self._data[kind])
+        return self._index(kind).search(query)
+
+    @instrumented
+    def search_mods(self, query: str = "") -> list[str]:
+        """
+        Ids of the mods whose name or description has words starting with every word of `query`
+        """
+        return self._search("mods", query)
+
+    @instrumented
+    def search_resources(self, query: str = "") -> list[str]:
+        """
+        Ids of the resources matching `query` on name, description or resource_type
+        """
+        return self._search("resources", query)
 
     def get_mods(self) -> list[Mod]:
         return self._data["mods"].values()
@@ -95,8 +840,8 @@ class ModManager:
     def get_resources(self) -> list[Resource]:
         return self._data["resources"].values()
 
-    def get_records(self) -> list[Record]:
-        return self._data["records"]
+    def get_records(self) -> RecordStore:
+        return self._current().records
 
     def get_mod(self, mod_id: str) -> Mod:
         return self._data["mods"][mod_id]
@@ -104,74 +849,320 @@ class ModManager:
     def get_resource(self, resource_id: str) -> Resource:
         return self._data["resources"][resource_id]
 
-    def get_record(self, record_id: str) -> Record:
-        return self._data["records"][record_id]
+    def get_record(self, record_id: str) -> list[Record]:
+        """
+        Records share the id of the mod which applied them
+        """
+        return self._current().records.of_mod(record_id)
 
+    @instrumented
     def get_mod_preview(self, mod_id: str, size: tuple[int, int]) -> list[Resource]:
         return self.resource_manager.get_mod_preview(mod_id, size)
 
+    @instrumented
     def load_data(self):
-        data_path = os.path.join(self._local_path, "data.json")
-        try:
-            with open(data_path, "r", encoding="utf-8") as f:
-                raw_data = json.load(f)
+        snapshot, ops = self._journal.load()
+        legacy = None
+        if snapshot is None:
+            data = {"mods": {}, "resources": {}, "profiles": {}, "targets": {},
+                    "max_mod_id": 1, "max_resource_id": 1}
+        elif isinstance(snapshot, LazyDict):
+            # mods and resources are only decoded when first used
+            data = LazyDict({
+                "mods": lambda: {row[0]: Mod(*row) for row in snapshot["mods"]},
+                "resources": lambda: dict(zip(snapshot["resources"][0], map(Resource, *snapshot["resources"]))),
+            }, profiles=snapshot["profiles"], targets=snapshot["targets"],
+                max_mod_id=snapshot["max_mod_id"], max_resource_id=snapshot["max_resource_id"])
+            if "records" in snapshot:
+                # records of a data.json opened without its game directory, see _load_target
+                legacy = {"records": RecordStore.from_rows(snapshot["records"]), "last_txn": snapshot["last_txn"]}
+        else:
+            # data.json of the first version
             data = {
-                "mods": {mod["id"]: Mod.from_json(mod) for mod in raw_data["mods"]},
-                "resources": {resource["id"]: Resource.from_json(resource) for resource in raw_data["resources"]},
-                "records": [Record.from_json(record) for record in raw_data["records"]],
-                "max_mod_id": raw_data["max_mod_id"],
-                "max_resource_id": raw_data["max_resource_id"]
+                "mods": {mod["id"]: Mod.from_json(mod) for mod in snapshot["mods"]},
+                "resources": {resource["id"]: Resource.from_json(resource) for resource in snapshot["resources"]},
+                "profiles": {},
+                "targets": {},
+                "max_mod_id": snapshot["max_mod_id"],
+                "max_resource_id": snapshot["max_resource_id"]
             }
-        except FileNotFoundError:
-            data = {"mods": {}, "resources": {}, "records": [], "max_mod_id": 1, "max_resource_id": 1}
-            with open(data_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
+            legacy = {"records": RecordStore(), "last_txn": None}
+            resources = data["resources"]
+            for record in snapshot["records"]:
+                resource = resources.get(record["resource_id"])
+                legacy["records"].add(record["id"], record["resource_id"],
+                                      resource.resource_hash if resource else "")
+        # replay the journal tail written after the snapshot
+        for op in ops:
+            self._apply_op(data, op)
+        self._legacy = legacy
+        if legacy is None and not isinstance(snapshot, LazyDict):
+            self._journal.compact(self._snapshot(data))
         return data
 
+    def _load_target(self, target: Target):
+        snapshot, ops = target.journal.load()
+        legacy = self._legacy if target.name == DEFAULT_TARGET else None
+        if snapshot is None:
+            data = legacy or {"records": RecordStore(), "last_txn": None}
+        else:
+            data = LazyDict({"records": lambda: RecordStore.from_rows(snapshot["records"])},
+                            last_txn=snapshot["last_txn"])
+        for op in ops:
+            self._apply_record_op(data, op, self._data["resources"])
+        if legacy is not None:
+            # the default target takes over the records kept in the library so far,
+            # its own snapshot is written before the library drops them
+            target.data = data
+            target.save()
+            self._legacy = None
+            self.save_data()
+        return data
+
+    def _snapshot(self, data) -> dict:
+        """
+        Fields of the binary snapshot, resources as one list per attribute.
+        A field never decoded since the last snapshot is written back as it was.
+        """
+        snapshot = {"profiles": data["profiles"], "targets": data["targets"],
+                    "max_mod_id": data["max_mod_id"], "max_resource_id": data["max_resource_id"]}
+        for key in ("mods", "resources"):
+            if isinstance(data, LazyDict) and not data.loaded(key):
+                snapshot[key] = self._journal.raw(key)
+        if "mods" not in snapshot:
+            snapshot["mods"] = [mod.to_row() for mod in data["mods"].values()]
+        if "resources" not in snapshot:
+            columns = [list(column) for column in zip(*(resource.to_row() for resource in data["resources"].values()))]
+            columns = columns or [[] for _ in range(6)]
+            # descriptions and types repeat a lot, equal strings are pickled once
+            for i in (3, 4):
+                shared = {}
+                columns[i] = [shared.setdefault(value, value) for value in columns[i]]
+            snapshot["resources"] = columns
+        if self._legacy is not None:
+            # records from before targets stay here until the default target takes them
+            snapshot["records"] = self._legacy["records"].rows()
+            snapshot["last_txn"] = self._legacy["last_txn"]
+        return snapshot
+
+    def export_data(self) -> dict:
+        data = self._data
+        target = self._current()
+        return {
+            "mods": [mod.to_json() for mod in data["mods"].values()],
+            "resources": [resource.to_json() for resource in data["resources"].values()],
+            "records": [record.to_json() for record in target.records],
+            "profiles": data["profiles"],
+            "targets": data["targets"],
+            "last_txn": target.data["last_txn"],
+            "max_mod_id": data["max_mod_id"],
+            "max_resource_id": data["max_resource_id"]
+        }
+
+    @instrumented
     def save_data(self):
-        data_path = os.path.join(self._local_path, "data.json")
-        with open(data_path, "w", encoding="utf-8") as f:
-            json.dump({
-                "mods": [mod.to_json() for mod in self._data["mods"].values()],
-                "resources": [resource.to_json() for resource in self._data["resources"].values()],
-                "records": [record.to_json() for record in self._data["records"]],
-                "max_mod_id": self._data["max_mod_id"],
-                "max_resource_id": self._data["max_resource_id"]
-            }, f, ensure_ascii=False, indent=4)
-
-    def add_resource(self, resource_path: str, name: str, description: str, resource_type: str):
+        """
+        Compact the journal into a fresh snapshot
+        """
+        self._journal.compact(self._snapshot(self._data))
+
+    @staticmethod
+    def _apply_op(data, op: dict):
+        # every change of _data goes through here, both live and on journal replay
+        kind = op["op"]
+        if kind == "add_resource":
+            resource = Resource.from_json(op["resource"])
+            data["resources"][resource.id] = resource
+            data["max_resource_id"] = resource.id
+        elif kind == "delete_resource":
+            data["resources"].pop(op["id"], None)
+        elif kind == "add_mod":
+            mod = Mod.from_json(op["mod"])
+            data["mods"][mod.id] = mod
+            data["max_mod_id"] = mod.id
+        elif kind == "delete_mod":
+            data["mods"].pop(op["id"], None)
+            # saved profiles lose the mod with it
+            for name, mod_ids in data["profiles"].items():
+                if op["id"] in mod_ids:
+                    data["profiles"][name] = [mod_id for mod_id in mod_ids if mod_id != op["id"]]
+        elif kind == "save_profile":
+            data["profiles"][op["name"]] = op["mod_ids"]
+        elif kind == "delete_profile":
+            data["profiles"].pop(op["name"], None)
+        elif kind == "set_priority":
+            data["mods"][op["mod_id"]].priority = op["priority"]
+        elif kind == "add_target":
+            data["targets"][op["name"]] = op["path"]
+        elif kind == "remove_target":
+            data["targets"].pop(op["name"], None)
+        else:
+            raise ValueError(f"Unknown journal op {kind}")
+
+    @staticmethod
+    def _check_op(data, op: dict):
+        # an op _apply_op can not apply must never reach the journal, every later start would replay it
+        kind = op["op"]
+        if kind not in LIBRARY_OPS:
+            raise ValueError(f"Unknown journal op {kind}")
+        missing = [field for field in LIBRARY_OPS[kind] if field not in op]
+        if missing:
+            raise ValueError(f"Journal op {kind} misses {', '.join(missing)}")
+        if kind == "add_resource":
+            Resource.from_json(op["resource"])
+        elif kind == "add_mod":
+            Mod.from_json(op["mod"])
+        elif kind == "save_profile":
+            for mod_id in op["mod_ids"]:
+                if mod_id not in data["mods"]:
+                    raise KeyError(mod_id)
+        elif kind == "set_priority":
+            if op["mod_id"] not in data["mods"]:
+                raise KeyError(op["mod_id"])
+            if not isinstance(op["priority"], int):
+                raise ValueError(f"Priority of mod {op['mod_id']} must be an integer")
+
+    @staticmethod
+    def _apply_record_op(data, op: dict, resources: dict):
+        # every change of a target's records goes through here, both live and on journal replay
+        kind = op["op"]
+        if "txn" in op:
+            data["last_txn"] = op["txn"]
+        if kind == "apply_mod":
+            for resource_id in op["resource_ids"]:
+                data["records"].add(op["mod_id"], resource_id, resources[resource_id].resource_hash)
+        elif kind == "reset_mod":
+            for resource_id in op["resource_ids"]:
+                data["records"].remove(op["mod_id"], resource_id, resources[resource_id].resource_hash)
+        elif kind != "commit":
+            raise ValueError(f"Unknown journal op {kind}")
+
+    def _commit(self, *ops: dict):
+        """
+        Persist library operations to the journal, then apply them in memory
+        """
+        if not ops:
+            return
+        for op in ops:
+            self._check_op(self._data, op)
+        with self.metrics.timer("journal"):
+            self._journal.append(*ops)
+        for op in ops:
+            self._apply_op(self._data, op)
+            if self._indexes:
+                self._index_op(op)
+        if self._journal.need_compact():
+            self.save_data()
+
+    def _commit_target(self, target: Target, *ops: dict, txn: Optional[str] = None):
+        """
+        Persist record operations to the journal of `target`, then apply them in memory.
+        With `txn` the last op marks that batch as committed and its intent is closed.
+        """
+        if ops:
+            if txn is not None:
+                ops[-1]["txn"] = txn
+            with self.metrics.timer("journal"):
+                target.journal.append(*ops)
+            for op in ops:
+                self._apply_record_op(target.data, op, self._data["resources"])
+            if target.journal.need_compact():
+                target.save()
+        if txn is not None:
+            target.intent.end()
+
+    @instrumented
+    def add_resource(self, resource_path: str, name: str, description: str, resource_type: str) -> str:
         # 记录资源
         resource_id = str(int(self._data['max_resource_id']) + 1)
-        self._data['max_resource_id'] = resource_id
-        resource_hash = resource_path.split("/")[-1]
-        self.resource_manager.add_resource(
+        resource_hash = resource_hash_of(resource_path)
+        digest = self.resource_manager.add_resource(
             resource_id, resource_hash, resource_path)
-        self._data["resources"][str(resource_id)] = Resource(
-            id=str(resource_id), resource_hash=resource_hash, name=name, description=description, resource_type=resource_type)
+        resource = Resource(
+            id=resource_id, resource_hash=resource_hash, name=name, description=description, resource_type=resource_type,
+            digest=digest)
+        self._commit({"op": "add_resource", "resource": resource.to_json()})
+        return resource_id
+
+    @instrumented
+    def import_resources(self, source: str, resource_type: str = "", description: str = "",
+                         shard_only: bool = False, max_workers: Optional[int] = None,
+                         progress: Optional[Callable[[int, int], None]] = None) -> list[str]:
+        """
+        批量导入目录或压缩包 (zip/tar/7z), 资源名为其 resource_hash.
+        shard_only 只导入 `xx/<hash>` 结构中的文件. 所有资源在一次journal写入中提交.
+        """
+        with scan(source) as (entries, parallel):
+            if shard_only:
+                entries = [entry for entry in entries if in_shard(entry.path)]
+            first_id = int(self._data['max_resource_id']) + 1
+            resource_ids = [str(first_id + i) for i in range(len(entries))]
+            digests = self.resource_manager.import_entries(
+                list(zip(resource_ids, entries)), parallel=parallel, max_workers=max_workers, progress=progress)
+        ops = [{"op": "add_resource", "resource": Resource(
+            id=resource_id, resource_hash=entry.resource_hash, name=entry.resource_hash, description=description,
+            resource_type=resource_type, digest=digest).to_json()}
+            for resource_id, entry, digest in zip(resource_ids, entries, digests)]
+        if ops:
+            self._commit(*ops)
+        print(f"Imported {len(ops)} resources.")
+        return resource_ids
+
+    @instrumented
+    def delete_resource(self, resource_id: str):
+        # 删除资源, 被mod引用或已应用的资源不能删除
+        for mod in self._data["mods"].values():
+            if resource_id in mod.resource_ids:
+                raise ValueError(f"Resource {resource_id} is used by mod {mod.id}")
+        for target in self._all_targets():
+            for mod_id in target.records.mods_of_resource(resource_id):
+                raise ValueError(f"Resource {resource_id} is applied by mod {mod_id} on {target.name}")
+        resource = self._data["resources"][resource_id]
+        # counted from the resources, so before this one leaves them
+        self.resource_manager.blob_store.refs()
+        self._commit({"op": "delete_resource", "id": resource_id})
+        self.resource_manager.delete_resource(
+            resource_id, resource.resource_hash, resource.digest)
 
+    @instrumented
     def delete_mod(self, mod_id: str):
-        # 删除mod
+        # 删除mod, 在任一目标上已应用的mod需要先重置, 保存的配置中同时去掉它
+        for target in self._all_targets():
+            if target.records.is_applied(mod_id):
+                raise ValueError(f"Mod {mod_id} is applied on {target.name}, reset it first")
         # mod = self._data["mods"][mod_id]
         # for resource_id in mod.resource_ids:
         #     self.resource_manager.delete_resource(
         #         resource_hash=self._data["resources"][resource_id].resource_hash)
-        del self._data["mods"][mod_id]
+        self._commit({"op": "delete_mod", "id": mod_id})
 
-    def add_mod(self, resource_ids: list[str], name: str, description: str, preview_path: str):
+    @instrumented
+    def add_mod(self, resource_ids: list[str], name: str, description: str, preview_path: str) -> str:
         # 记录mod
         mod_id = str(int(self._data['max_mod_id']) + 1)
-        self._data['max_mod_id'] = mod_id
-        self._data['max_mod_id'] = mod_id
-        self._data["mods"][str(mod_id)] = Mod(
-            id=str(mod_id), name=name, description=description, resource_ids=resource_ids)
         if preview_path:
             self.resource_manager.add_mod_preview(
                 mod_id, preview_path
             )
+        mod = Mod(id=mod_id, name=name, description=description, resource_ids=resource_ids)
+        self._commit({"op": "add_mod", "mod": mod.to_json()})
+        return mod_id
 
     def init(self):
         self.resource_manager.init()
 
     def close(self):
-        self.resource_manager.close()
-        self.save_data()
+        for target in self._targets.values():
+            target.close()
+        if self._library is not None:
+            self._library.close()
+        # the snapshot is current unless operations were journaled since
+        if self._journal.pending:
+            self.save_data()
+        self._journal.close()
+
+    def __enter__(self) -> "ModManager":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,66 @@
+from typing import Callable, Iterable, Optional
+
+
+class OverlayPlan:
+    """
+    The game files whose winner changes, computed before any I/O.
+    `writes` get the resource of their new winner, `restores` go back to the backup.
+    """
+
+    def __init__(self) -> None:
+        self.writes: list[tuple[str, str]] = []  # (resource_id, resource_hash)
+        self.restores: list[str] = []  # resource_hash
+        # resource_hashes whose winner stays the same, they need no I/O
+        self.unchanged: list[str] = []
+        # size of the files to copy, only filled in when asked for
+        self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.writes) + len(self.restores)
+
+    def hashes(self) -> set[str]:
+        return {resource_hash for _, resource_hash in self.writes} | set(self.restores)
+
+
+def winner(candidates: Iterable, rank: Callable[[str], tuple]) -> Optional[object]:
+    """
+    The record of the highest ranked mod, a later record wins a tie
+    """
+    best = None
+    best_rank = None
+    for record in candidates:
+        record_rank = rank(record.id)
+        if best is None or record_rank >= best_rank:
+            best = record
+            best_rank = record_rank
+    return best
+
+
+def plan_overlay(hashes: Iterable[str], before: Callable[[str], Optional[str]],
+                 after: Callable[[str], Optional[str]]) -> OverlayPlan:
+    """
+    Compare the winning resource_id of each game file before and after a change of the stack
+    """
+    plan = OverlayPlan()
+    for resource_hash in hashes:
+        old = before(resource_hash)
+        new = after(resource_hash)
+        if old == new:
+            plan.unchanged.append(resource_hash)
+        elif new is None:
+            plan.restores.append(resource_hash)
+        else:
+            plan.writes.append((new, resource_hash))
+    return plan
+
+
+def compute_overlay(layers: Iterable[Iterable[tuple[str, str]]]) -> dict[str, str]:
+    """
+    resource_hash -> resource_id of the winner, `layers` are the (resource_id, resource_hash)
+    of each mod from the lowest to the highest priority
+    """
+    overlay = {}
+    for layer in layers:
+        for resource_id, resource_hash in layer:
+            overlay[resource_hash] = resource_id
+    return overlay
@@ -0,0 +1,103 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+from .metrics import NULL_METRICS, Metrics
+
+# thumbnails pre-generated on disk when a preview is added
+PREVIEW_SIZES = ((250, 250), (500, 500))
+
+
+def render_thumbnail(preview_path: str, size: tuple[int, int]) -> bytes:
+    from PIL import Image
+    with Image.open(preview_path) as image:
+        # let the decoder downscale JPEG while decoding, then reduce() by integer
+        # factors before the final resample
+        image.draft("RGB", size)
+        image.thumbnail(size, reducing_gap=2.0)
+        with io.BytesIO() as output:
+            image.save(output, format="PNG", compress_level=1)
+            return output.getvalue()
+
+
+class PreviewCache:
+    """
+    Encoded mod previews, an in-memory LRU keyed by (mod_id, size, mtime) in front of
+    `mod/<id>/preview_<w>x<h>.png` thumbnails on disk
+    """
+
+    def __init__(self, mod_path: str, capacity: int = 64, metrics: Metrics = NULL_METRICS) -> None:
+        self.mod_path = mod_path
+        self.capacity = capacity
+        self.metrics = metrics
+        self._entries: OrderedDict[tuple, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def preview_path(self, mod_id: str) -> str:
+        return os.path.join(self.mod_path, mod_id, "preview.png")
+
+    def thumbnail_path(self, mod_id: str, size: tuple[int, int]) -> str:
+        return os.path.join(self.mod_path, mod_id, "preview_{}x{}.png".format(*size))
+
+    def get(self, mod_id: str, size: tuple[int, int]) -> Optional[bytes]:
+        try:
+            mtime = os.stat(self.preview_path(mod_id)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        key = (mod_id, tuple(size), mtime)
+        with self._lock:
+            png_bytes = self._entries.get(key)
+            if png_bytes is not None:
+                self._entries.move_to_end(key)
+                self.metrics.count("preview.memory_hit")
+                return png_bytes
+        png_bytes = self._load(mod_id, tuple(size), mtime)
+        with self._lock:
+            self._entries[key] = png_bytes
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return png_bytes
+
+    def _load(self, mod_id: str, size: tuple[int, int], mtime: int) -> bytes:
+        thumbnail_path = self.thumbnail_path(mod_id, size)
+        try:
+            if os.stat(thumbnail_path).st_mtime_ns >= mtime:
+                with open(thumbnail_path, "rb") as f:
+                    self.metrics.count("preview.disk_hit")
+                    return f.read()
+        except FileNotFoundError:
+            pass
+        self.metrics.count("preview.render")
+        with self.metrics.timer("preview.render"):
+            png_bytes = render_thumbnail(self.preview_path(mod_id), size)
+        if size in PREVIEW_SIZES:
+            self._write(thumbnail_path, png_bytes)
+        return png_bytes
+
+    @staticmethod
+    def _write(path: str, png_bytes: bytes):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(png_bytes)
+        os.replace(tmp_path, path)
+
+    def generate(self, mod_id: str):
+        """
+        Pre-generate the on-disk thumbnails of a mod
+        """
+        preview_path = self.preview_path(mod_id)
+        for size in PREVIEW_SIZES:
+            self._write(self.thumbnail_path(mod_id, size),
+                        render_thumbnail(preview_path, size))
+
+    def invalidate(self, mod_id: str):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == mod_id]:
+                del self._entries[key]
+        for size in PREVIEW_SIZES:
+            try:
+                os.remove(self.thumbnail_path(mod_id, size))
+            except FileNotFoundError:
+                pass
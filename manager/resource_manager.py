@@ -1,20 +1,59 @@
 import os
-from PIL import Image
-import io
 import shutil
+import threading
+from functools import partial
+from typing import Callable, Optional
+from .batch import BatchPlan, BatchResult, default_workers, run_plan
+from concurrent.futures import ThreadPoolExecutor
+from .backup_store import BackupStore
+from .blob_store import BlobStore, file_digest
+from .deploy import COPY, STAGING_SUFFIX, Deployer, SharedReads, remove_file
+from .integrity import DEPLOYED, Manifest, VerifyReport, fast_digest, verify
+from .importer import ImportEntry
+from .metrics import NULL_METRICS, Metrics, instrumented
+from .overlay import OverlayPlan
+from .preview_cache import PreviewCache
 
 
 class ResourceManager:
     """
     Directly Manage with FileSystem
+
+    Resources, mod previews and backup objects are in the library at `local_path`,
+    backup pointers and the manifest of the game directory in `state_path` (the library
+    itself by default). Managers of several game directories share one library by
+    passing the blob_store and preview_cache of the first one, and `backup_roots`
+    listing the backup pointer folders of all of them. `blob_refs` counts the resource
+    files linked to each blob, by default by hashing every one of them.
     """
 
-    def __init__(self, local_path, target_path):
+    def __init__(self, local_path, target_path, deploy_strategy: str = COPY, durable: bool = True,
+                 backup_codec: Optional[str] = None, snapshot_path: Optional[str] = None,
+                 metrics: Metrics = NULL_METRICS, state_path: Optional[str] = None,
+                 blob_store: Optional[BlobStore] = None, preview_cache: Optional[PreviewCache] = None,
+                 backup_roots: Optional[Callable[[], list[str]]] = None,
+                 blob_refs: Optional[Callable[[], dict[str, int]]] = None):
+        self.metrics = metrics
+        state_path = state_path or local_path
         self.resource_path = os.path.join(local_path, "resource")
-        self.backup_path = os.path.join(local_path, "backup")
+        self.backup_path = os.path.join(state_path, "backup")
         self.mod_path = os.path.join(local_path, "mod")
         self.init_folder()
         self.game_resource_path = target_path
+        self.deployer = Deployer(deploy_strategy)
+        # fsync staged files before they replace live ones
+        self.durable = durable
+        self.preview_cache = preview_cache or PreviewCache(self.mod_path, metrics=metrics)
+        self.manifest = Manifest(os.path.join(state_path, "manifest.json"))
+        self.blob_store = blob_store or BlobStore(os.path.join(local_path, "blob"), blob_refs or self.resource_refs,
+                                                  metrics=metrics)
+        if blob_store is None and not self.blob_store.loaded:
+            self.migrate_resources()
+        self.backup_store = BackupStore(self.backup_path, os.path.join(local_path, "backup_store"),
+                                        codec=backup_codec, snapshot_path=snapshot_path, durable=durable,
+                                        metrics=metrics, pointer_roots=backup_roots)
+        if not self.backup_store.loaded:
+            self.backup_store.migrate()
 
     def init_folder(self):
         os.makedirs(self.resource_path, exist_ok=True)
@@ -22,50 +61,284 @@ class ResourceManager:
         os.makedirs(self.mod_path, exist_ok=True)
 
     def get_mod_preview(self, resource_id: str, size: tuple[int, int] = (250, 250)):
-        preview_path = os.path.join(
-            self.mod_path, resource_id, "preview.png")
-        if not os.path.exists(preview_path):
-            return None
-        image = Image.open(preview_path)
-        image.thumbnail(size)
-        with io.BytesIO() as output:
-            image.save(output, format='PNG')
-            png_bytes = output.getvalue()
-        return png_bytes
+        return self.preview_cache.get(resource_id, size)
 
     def add_mod_preview(self, mod_id: str, preview_path: str):
         mod_preview_path = os.path.join(
             self.mod_path, mod_id, "preview.png")
         os.makedirs(os.path.dirname(mod_preview_path), exist_ok=True)
+        self.preview_cache.invalidate(mod_id)
         shutil.copyfile(preview_path, mod_preview_path)
+        self.preview_cache.generate(mod_id)
+
+    def game_file(self, resource_hash: str) -> str:
+        return os.path.join(self.game_resource_path, resource_hash[:2], resource_hash)
+
+    def backup_file(self, resource_hash: str) -> str:
+        return os.path.join(self.backup_path, resource_hash[:2], resource_hash)
+
+    def resource_file(self, resource_id: str, resource_hash: str) -> str:
+        return os.path.join(self.resource_path, resource_id, resource_hash)
+
+    # copy functions for batch plans, they stage the file next to its destination for
+    # the batch to rename, and keep the integrity manifest up to date.
+    # the file name of every game file and backup pointer is its resource_hash
+    def _backup(self, src: str, dst: str) -> str:
+        with self.metrics.timer("backup"):
+            return self.backup_store.stage(src, dst)
+
+    def _deploy(self, src: str, dst: str, shared_reads: Optional[SharedReads] = None) -> str:
+        with self.metrics.timer("deploy"):
+            tmp_path = self.deployer.stage(src, dst, copy=shared_reads.copy if shared_reads else shutil.copyfile)
+        # the expected content is pinned now, a linked source may change together with the game file
+        with self.metrics.timer("digest"):
+            digest = fast_digest(tmp_path)
+        with self.metrics.timer("manifest"):
+            self.manifest.track(DEPLOYED, os.path.basename(dst), tmp_path, src, digest)
+        return tmp_path
+
+    def _restore(self, src: str, dst: str) -> str:
+        # decompressed on the batch workers, so a reset decompresses in parallel
+        with self.metrics.timer("restore"):
+            tmp_path, digest = self.backup_store.stage_restore(
+                os.path.basename(dst), dst, self.deployer.stage_restore)
+        with self.metrics.timer("manifest"):
+            self.manifest.track(DEPLOYED, os.path.basename(dst), tmp_path, src, digest)
+        return tmp_path
+
+    def has_backup(self, resource_hash: str) -> bool:
+        return os.path.exists(self.backup_file(resource_hash))
+
+    def clean_staging(self, resource_hashes):
+        """
+        Remove files staged by an interrupted batch
+        """
+        for folder in {os.path.dirname(path) for resource_hash in resource_hashes
+                       for path in (self.game_file(resource_hash), self.backup_file(resource_hash))}:
+            try:
+                names = os.listdir(folder)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                if name.endswith(STAGING_SUFFIX):
+                    remove_file(os.path.join(folder, name))
+
+    def _list_backups(self, shards: set[str]) -> set[str]:
+        # one listdir per shard instead of one exists() per file
+        backups = set()
+        with self.metrics.timer("list_backups"):
+            for shard in shards:
+                try:
+                    backups.update(os.listdir(os.path.join(self.backup_path, shard)))
+                except FileNotFoundError:
+                    pass
+        return backups
+
+    def _plan(self, writes: list[tuple[str, str]], restores: list[str],
+              shared_reads: Optional[SharedReads] = None) -> BatchPlan:
+        """
+        `writes` (resource_id, resource_hash) get a resource, taking a backup first if there is none,
+        `restores` (resource_hash) get their backup. Tasks are keyed by resource_hash.
+        """
+        backups = self._list_backups({resource_hash[:2] for _, resource_hash in writes})
+        deploy = self._deploy if shared_reads is None else partial(self._deploy, shared_reads=shared_reads)
+        plan = BatchPlan()
+        for resource_id, resource_hash in writes:
+            shard = resource_hash[:2]
+            game_resource_path = self.game_file(resource_hash)
+            if resource_hash not in backups:
+                plan.add(shard, game_resource_path, self.backup_file(resource_hash), self._backup)
+                backups.add(resource_hash)
+            plan.add(shard, self.resource_file(resource_id, resource_hash), game_resource_path, deploy,
+                     key=resource_hash)
+        for resource_hash in restores:
+            plan.add(resource_hash[:2], self.backup_file(resource_hash), self.game_file(resource_hash),
+                     self._restore, key=resource_hash)
+        return plan
+
+    @instrumented
+    def apply_overlay(self, writes: list[tuple[str, str]], restores: list[str], max_workers: Optional[int] = None,
+                      progress: Optional[Callable[[int, int], None]] = None,
+                      cancel: Optional[threading.Event] = None, completed: Optional[list[str]] = None,
+                      shared_reads: Optional[SharedReads] = None) -> BatchResult:
+        """
+        Run an overlay plan in one batch, finished resource_hashes are appended to `completed`.
+        Copies read their source through `shared_reads` when other targets copy it too.
+        """
+        return run_plan(self._plan(writes, restores, shared_reads=shared_reads), max_workers=max_workers,
+                        progress=progress, cancel=cancel, completed=completed,
+                        durable=self.durable, metrics=self.metrics)
+
+    def plan_bytes(self, plan: OverlayPlan) -> int:
+        """
+        Bytes an overlay plan will copy, backups it still has to take are not counted
+        """
+        total = 0
+        for resource_id, resource_hash in plan.writes:
+            total += os.path.getsize(self.resource_file(resource_id, resource_hash))
+        for resource_hash in plan.restores:
+            total += self.backup_store.size(resource_hash)
+        return total
 
-    def apply_resource(self, resource_id: str, resource_hash: str):
+    def tracked(self) -> list[str]:
+        """
+        Game files we wrote, the ones a watcher has to look after
+        """
+        return self.manifest.keys(DEPLOYED)
+
+    @instrumented
+    def verify(self, owned: dict[str, str], max_workers: Optional[int] = None,
+               hashes: Optional[set[str]] = None) -> VerifyReport:
+        """
+        Check the game files we deployed and the backups we took,
+        `owned` maps resource_hash -> resource_id applied there.
+        `hashes` limits the check to these game files, those we never touched are skipped.
+        """
+        if hashes is not None:
+            hashes = {resource_hash for resource_hash in hashes
+                      if resource_hash in owned or self.manifest.get(DEPLOYED, resource_hash) is not None
+                      or self.has_backup(resource_hash)}
+        else:
+            hashes = set(owned) | set(self.manifest.keys(DEPLOYED))
+            for shard in os.listdir(self.backup_path):
+                if os.path.isdir(os.path.join(self.backup_path, shard)):
+                    hashes.update(os.listdir(os.path.join(self.backup_path, shard)))
+        report = verify(self.manifest, hashes, owned, self.game_file, self.resource_file,
+                        self.backup_store.check, self.backup_store.digest, max_workers=max_workers)
+        self.manifest.save()
+        return report
+
+    @instrumented
+    def repair(self, report: VerifyReport, owned: dict[str, str], max_workers: Optional[int] = None) -> BatchResult:
+        """
+        Re-copy only what drifted. A game file which differs from what we left there
+        was patched by the game, so it becomes the new backup before the mod is re-applied.
+        Damaged backups of owned files can not be repaired, the original is gone, and
+        neither can damaged resources, their mod content has to be imported again.
+        """
+        if report.damaged_resources:
+            print("Resources changed through linked game files, import them again:",
+                  ", ".join(sorted(report.damaged_resources)))
+        plan = BatchPlan()
+        for resource_hash in report.clobbered:
+            plan.add(resource_hash[:2], self.game_file(resource_hash), self.backup_file(resource_hash), self._backup)
+            plan.add(resource_hash[:2], self.resource_file(owned[resource_hash], resource_hash),
+                     self.game_file(resource_hash), self._deploy)
+        for resource_hash in report.missing:
+            plan.add(resource_hash[:2], self.resource_file(owned[resource_hash], resource_hash),
+                     self.game_file(resource_hash), self._deploy)
+        refresh = set(report.stale_backups)
+        refresh.update(resource_hash for resource_hash in report.damaged_backups
+                       if resource_hash not in owned and os.path.exists(self.game_file(resource_hash)))
+        for resource_hash in refresh:
+            plan.add(resource_hash[:2], self.game_file(resource_hash), self.backup_file(resource_hash), self._backup)
+        result = run_plan(plan, max_workers=max_workers, durable=self.durable, metrics=self.metrics)
+        for resource_hash in refresh:
+            self.manifest.track(DEPLOYED, resource_hash, self.game_file(resource_hash), self.backup_file(resource_hash),
+                                self.backup_store.digest(resource_hash))
+        if refresh or report.clobbered:
+            # the replaced backups may have been the last users of their objects
+            self.backup_store.gc()
+        self.manifest.save()
+        return result
+
+    def forget_backups(self):
+        """
+        Drop the backups and the manifest of the game directory, before it is replaced by
+        another one whose original files they are not
+        """
+        shutil.rmtree(self.backup_path, ignore_errors=True)
+        os.makedirs(self.backup_path, exist_ok=True)
+        self.manifest.clear()
+        self.manifest.save()
+        self.backup_store.gc()
+
+    def backup_stats(self) -> dict:
+        return self.backup_store.stats()
+
+    @instrumented
+    def add_resource(self, resource_id: str, resource_hash: str, resource_path: str) -> str:
+        """
+        Import a file through the blob store, return its content digest
+        """
         mod_resource_path = os.path.join(
             self.resource_path, resource_id, resource_hash)
-        game_resource_path = os.path.join(
-            self.game_resource_path, resource_hash[:2], resource_hash)
-        backup_resource_path = os.path.join(
-            self.backup_path, resource_hash[:2], resource_hash)
-        # Save game resource to backup if not Exist
-        if not os.path.exists(backup_resource_path):
-            os.makedirs(os.path.dirname(backup_resource_path), exist_ok=True)
-            shutil.copyfile(game_resource_path, backup_resource_path)
-        # replace game resource with mod resource
-        shutil.copyfile(mod_resource_path, game_resource_path)
-
-    def reset_resource(self, resource_hash: str):
-        game_resource_path = os.path.join(
-            self.game_resource_path, resource_hash[:2], resource_hash)
-        backup_resource_path = os.path.join(
-            self.backup_path, resource_hash[:2], resource_hash)
-        # replace game resource with backup resource
-        shutil.copyfile(backup_resource_path, game_resource_path)
-
-    def add_resource(self, resource_id: str, resource_hash: str, resource_path: str):
+        digest = self.blob_store.put_file(resource_path)
+        self.blob_store.link(digest, mod_resource_path)
+        return digest
+
+    @instrumented
+    def import_entries(self, entries: list[tuple[str, ImportEntry]], parallel: bool = True,
+                       max_workers: Optional[int] = None,
+                       progress: Optional[Callable[[int, int], None]] = None) -> list[str]:
+        """
+        Stream (resource_id, entry) pairs into the blob store on a worker pool,
+        return the digests in the same order. On failure the already imported
+        ones are removed again so nothing is left without metadata.
+        """
+        done = []
+        lock = threading.Lock()
+
+        def import_one(item: tuple[str, ImportEntry]) -> str:
+            resource_id, entry = item
+            with entry.open() as stream:
+                digest = self.blob_store.put_stream(stream)
+            self.blob_store.link(digest, self.resource_file(resource_id, entry.resource_hash))
+            with lock:
+                done.append((resource_id, entry.resource_hash, digest))
+                count = len(done)
+            if progress is not None:
+                progress(count, len(entries))
+            return digest
+
+        try:
+            if not parallel:
+                return [import_one(item) for item in entries]
+            with ThreadPoolExecutor(max_workers=max_workers or default_workers()) as pool:
+                return list(pool.map(import_one, entries))
+        except BaseException:
+            for resource_id, resource_hash, digest in done:
+                self.delete_resource(resource_id, resource_hash, digest)
+            raise
+
+    @instrumented
+    def delete_resource(self, resource_id: str, resource_hash: str, digest: Optional[str] = None):
         mod_resource_path = os.path.join(
             self.resource_path, resource_id, resource_hash)
-        os.makedirs(os.path.dirname(mod_resource_path), exist_ok=True)
-        shutil.copyfile(resource_path, mod_resource_path)
+        if digest is None:
+            digest = file_digest(mod_resource_path)
+        try:
+            # linked to a sealed blob
+            remove_file(mod_resource_path)
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(os.path.join(self.resource_path, resource_id), ignore_errors=True)
+        self.blob_store.release(digest)
+
+    def migrate_resources(self):
+        """
+        Move the old `resource/<id>/<hash>` copies into the blob store in place
+        """
+        for resource_id in os.listdir(self.resource_path):
+            resource_dir = os.path.join(self.resource_path, resource_id)
+            if not os.path.isdir(resource_dir):
+                continue
+            for resource_hash in os.listdir(resource_dir):
+                self.blob_store.adopt(os.path.join(resource_dir, resource_hash))
+
+    def resource_refs(self) -> dict[str, int]:
+        """
+        Number of resource files with each digest
+        """
+        refs = {}
+        for resource_id in os.listdir(self.resource_path):
+            resource_dir = os.path.join(self.resource_path, resource_id)
+            if not os.path.isdir(resource_dir):
+                continue
+            for resource_hash in os.listdir(resource_dir):
+                digest = file_digest(os.path.join(resource_dir, resource_hash))
+                refs[digest] = refs.get(digest, 0) + 1
+        return refs
 
     def init(self):
         # Create Resource Directory
@@ -76,4 +349,4 @@ class ResourceManager:
         pass
 
     def close(self):
-        pass
+        self.manifest.save()
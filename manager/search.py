@@ -0,0 +1,112 @@
+import re
+from bisect import bisect_left
+from typing import Iterable
+
+_WORD = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> set[str]:
+    """
+    Lower case words of `text`. CJK names have no spaces, so words with
+    non-ascii characters also get their character bigrams, closed by the last
+    character alone: a search intersects them to find any substring.
+    """
+    tokens = set()
+    for word in _WORD.findall(text.lower()):
+        tokens.add(word)
+        if not word.isascii():
+            tokens.update(word[i:i + 2] for i in range(len(word)))
+    return tokens
+
+
+class SearchIndex:
+    """
+    In-memory inverted index from word to ids, updated one id at a time.
+    A query matches the ids having, for each of its words, a word starting with it,
+    or containing it for query words with non-ascii characters.
+    Results keep the order the ids were added in.
+    """
+
+    def __init__(self) -> None:
+        self._order: dict[str, None] = {}
+        self._tokens: dict[str, set[str]] = {}
+        self._postings: dict[str, set[str]] = {}
+        # sorted words for prefix lookups, rebuilt on the first query after a change
+        self._sorted: list[str] = []
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._order
+
+    def add(self, id: str, *texts: str):
+        if id in self._order:
+            self.remove(id)
+        tokens = set()
+        for text in texts:
+            tokens.update(tokenize(text or ""))
+        self._order[id] = None
+        self._tokens[id] = tokens
+        for token in tokens:
+            ids = self._postings.get(token)
+            if ids is None:
+                self._postings[token] = {id}
+                self._dirty = True
+            else:
+                ids.add(id)
+
+    def remove(self, id: str):
+        if id not in self._order:
+            return
+        del self._order[id]
+        for token in self._tokens.pop(id):
+            ids = self._postings[token]
+            ids.discard(id)
+            if not ids:
+                del self._postings[token]
+                self._dirty = True
+
+    def _prefixed(self, prefix: str) -> set[str]:
+        if self._dirty:
+            self._sorted = sorted(self._postings)
+            self._dirty = False
+        ids = set()
+        i = bisect_left(self._sorted, prefix)
+        while i < len(self._sorted) and self._sorted[i].startswith(prefix):
+            ids.update(self._postings[self._sorted[i]])
+            i += 1
+        return ids
+
+    def _containing(self, word: str) -> set[str]:
+        # every bigram of `word` is only a candidate, they may be apart in the text
+        ids = None
+        for i in range(len(word) - 1):
+            bigram_ids = self._postings.get(word[i:i + 2], set())
+            ids = set(bigram_ids) if ids is None else ids & bigram_ids
+            if not ids:
+                return set()
+        return {id for id in ids if any(word in token for token in self._tokens[id])}
+
+    def search(self, query: str = "") -> list[str]:
+        """
+        Ids matching every word of `query`, all ids for an empty query
+        """
+        words = _WORD.findall(query.lower())
+        if not words:
+            return list(self._order)
+        matches = None
+        for word in sorted(words, key=len, reverse=True):
+            ids = self._prefixed(word) if word.isascii() or len(word) == 1 else self._containing(word)
+            matches = ids if matches is None else matches & ids
+            if not matches:
+                return []
+        return [id for id in self._order if id in matches]
+
+    def update(self, items: Iterable[tuple]):
+        """
+        Add many (id, *texts) at once
+        """
+        for id, *texts in items:
+            self.add(id, *texts)
@@ -0,0 +1,217 @@
+import os
+import select
+from abc import ABC, abstractmethod
+import struct
+import time
+from typing import Callable, Iterable, Optional
+from .deploy import STAGING_SUFFIX
+
+# from linux/inotify.h
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# a plain write only counts once the game closes the file, not on every chunk
+SHARD_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+ROOT_MASK = IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_ONLYDIR
+EVENT = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+
+def is_shard(name: str) -> bool:
+    return len(name) == 2
+
+
+class Watcher(ABC):
+    """
+    Game files (`<root>/xx/<hash>`) changed since the last call of `changes`.
+    Files we stage ourselves are skipped, the renames which publish them are not:
+    telling our own writes from the game's is left to the integrity manifest.
+    """
+
+    @abstractmethod
+    def changes(self) -> Optional[set[str]]:
+        """
+        resource_hashes changed since the last call, None when changes may have
+        been lost and everything has to be checked again
+        """
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Block up to `timeout` seconds for a change, False if none came
+        """
+        time.sleep(timeout)
+        return True
+
+    def close(self):
+        pass
+
+    def __enter__(self) -> "Watcher":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class InotifyWatcher(Watcher):
+    """
+    One inotify watch per shard folder, plus one on the root for shards created later.
+    Raises OSError where inotify is missing or out of watches.
+    """
+
+    def __init__(self, root: str) -> None:
+        import ctypes
+        import ctypes.util
+        self.root = root
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._get_errno = ctypes.get_errno
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            self._raise()
+        # wd -> shard name, "" for the root
+        self._shards: dict[int, str] = {}
+        self._changed: set[str] = set()
+        self._lost = False
+        try:
+            self._add(root, "")
+            for shard in os.listdir(root):
+                if is_shard(shard) and os.path.isdir(os.path.join(root, shard)):
+                    self._add(os.path.join(root, shard), shard)
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def _raise(self, path: Optional[str] = None):
+        code = self._get_errno()
+        raise OSError(code, os.strerror(code), path)
+
+    def _add(self, path: str, shard: str):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), ROOT_MASK if shard == "" else SHARD_MASK)
+        if wd < 0:
+            self._raise(path)
+        self._shards[wd] = shard
+
+    def _add_shard(self, shard: str):
+        path = os.path.join(self.root, shard)
+        try:
+            self._add(path, shard)
+            names = os.listdir(path)
+        except FileNotFoundError:
+            return
+        # files created before the watch was in place
+        self._changed.update(name for name in names if not name.endswith(STAGING_SUFFIX))
+
+    def _read(self):
+        while True:
+            try:
+                buffer = os.read(self._fd, READ_SIZE)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = EVENT.unpack_from(buffer, offset)
+                offset += EVENT.size
+                name = os.fsdecode(buffer[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                self._event(wd, mask, name)
+
+    def _event(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            self._lost = True
+            return
+        shard = self._shards.get(wd)
+        if shard is None:
+            return
+        if mask & IN_IGNORED:
+            del self._shards[wd]
+            return
+        if shard == "":
+            if not (mask & IN_ISDIR and is_shard(name)):
+                return
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_shard(name)
+            else:
+                # a shard moved away takes its files without an event for each
+                self._lost = True
+        elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            self._lost = True
+        elif name and not name.endswith(STAGING_SUFFIX):
+            self._changed.add(name)
+
+    def changes(self) -> Optional[set[str]]:
+        self._read()
+        changed, self._changed = self._changed, set()
+        if self._lost:
+            self._lost = False
+            return None
+        return changed
+
+    def wait(self, timeout: float) -> bool:
+        if self._changed or self._lost:
+            return True
+        try:
+            readable, _, _ = select.select([self._fd], [], [], timeout)
+        except InterruptedError:
+            return False
+        return bool(readable)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher(Watcher):
+    """
+    Compares stat snapshots of the tracked game files only, `tracked` gives their
+    resource_hashes. A change is reported once its stat held still for one poll,
+    so a file the game is still writing is not picked up half done.
+    """
+
+    def __init__(self, root: str, tracked: Callable[[], Iterable[str]]) -> None:
+        self.root = root
+        self._tracked = tracked
+        self._snapshot = self._scan()
+        self._unsettled: set[str] = set()
+
+    def _scan(self) -> dict[str, Optional[tuple]]:
+        snapshot = {}
+        for resource_hash in self._tracked():
+            try:
+                st = os.lstat(os.path.join(self.root, resource_hash[:2], resource_hash))
+            except FileNotFoundError:
+                snapshot[resource_hash] = None
+                continue
+            snapshot[resource_hash] = (st.st_size, st.st_mtime_ns, st.st_ino)
+        return snapshot
+
+    def changes(self) -> Optional[set[str]]:
+        previous, self._snapshot = self._snapshot, self._scan()
+        moved = {resource_hash for resource_hash, stat in self._snapshot.items()
+                 if previous.get(resource_hash, stat) != stat}
+        settled = self._unsettled - moved
+        self._unsettled = (self._unsettled | moved) - settled
+        return settled
+
+
+def open_watcher(root: str, tracked: Callable[[], Iterable[str]], poll: bool = False) -> Watcher:
+    """
+    inotify where it works, stat polling of the tracked files otherwise
+    """
+    if not poll:
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(root, tracked)
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def write(path: str, content: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """
+    A library folder, a game directory of 100 `xx/<hash>` files and a mod source overriding all of them
+    """
+    local, game, source = (str(tmp_path / name) for name in ("local", "game", "source"))
+    os.makedirs(local)
+    hashes = ["%08x" % (i * 2654435761 % 2**32) for i in range(100)]
+    for resource_hash in hashes:
+        write(os.path.join(game, resource_hash[:2], resource_hash), b"orig" + resource_hash.encode())
+        write(os.path.join(source, resource_hash[:2], resource_hash), b"mod" + resource_hash.encode())
+    return local, game, source, hashes
+
+
+def crash(script: str, local: str):
+    """
+    Run `script` in a child process which has to die with os._exit(9), leaving an intent behind
+    """
+    assert subprocess.call([sys.executable, "-c", f"import os, sys\nsys.path.insert(0, {ROOT!r})\n" + script]) == 9
+    assert os.path.exists(os.path.join(local, "intent.json"))
+
+
+def game_files(game: str, hashes: list[str]) -> list[bytes]:
+    return [read(os.path.join(game, resource_hash[:2], resource_hash)) for resource_hash in hashes]
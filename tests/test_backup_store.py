@@ -0,0 +1,77 @@
+import os
+
+from conftest import read, write
+
+from manager.backup_store import BackupStore, ZLIB
+from manager.deploy import staging_path
+from manager.integrity import OK
+
+
+def make_store(tmp_path, name: str = "target") -> BackupStore:
+    return BackupStore(str(tmp_path / name / "backup"), str(tmp_path / "backup_store"), codec=ZLIB)
+
+
+def objects(store: BackupStore) -> list[str]:
+    return sorted(name for shard in os.listdir(store.root) if os.path.isdir(os.path.join(store.root, shard))
+                  for name in os.listdir(os.path.join(store.root, shard)))
+
+
+def back_up(store: BackupStore, src: str, resource_hash: str):
+    dst = store.pointer_file(resource_hash)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    os.replace(store.stage(src, dst), dst)
+
+
+def test_identical_content_is_stored_once(tmp_path):
+    store = make_store(tmp_path)
+    content = b"original bundle " * 1000
+    for resource_hash in ("aa11", "bb22", "cc33"):
+        write(str(tmp_path / "game" / resource_hash), content)
+        back_up(store, str(tmp_path / "game" / resource_hash), resource_hash)
+    assert len(objects(store)) == 1
+    assert store.stats()["backups"] == 3 and store.stats()["objects"] == 1
+    assert {store.digest(resource_hash) for resource_hash in ("aa11", "bb22", "cc33")} == {
+        objects(store)[0].split(".")[0]}
+
+
+def test_gc_keeps_objects_of_other_targets_and_staged_pointers(tmp_path):
+    stores = {}
+    roots = lambda: [store.pointer_root for store in stores.values()]
+    for name in ("one", "two"):
+        stores[name] = BackupStore(str(tmp_path / name / "backup"), str(tmp_path / "backup_store"), codec=ZLIB,
+                                   pointer_roots=roots)
+    one, two = stores["one"], stores["two"]
+    write(str(tmp_path / "shared"), b"shared" * 100)
+    write(str(tmp_path / "dropped"), b"dropped" * 100)
+    write(str(tmp_path / "staged"), b"staged" * 100)
+    back_up(one, str(tmp_path / "shared"), "aa11")
+    back_up(two, str(tmp_path / "shared"), "aa11")
+    back_up(one, str(tmp_path / "dropped"), "bb22")
+    # a batch which staged its pointer and has not renamed it yet
+    staged = staging_path(one.pointer_file("cc33"))
+    os.makedirs(os.path.dirname(staged), exist_ok=True)
+    os.replace(one.stage(str(tmp_path / "staged"), one.pointer_file("cc33")), staged)
+    assert len(objects(one)) == 3
+
+    os.remove(one.pointer_file("aa11"))
+    os.remove(one.pointer_file("bb22"))
+    assert one.gc() == 1
+    assert len(objects(one)) == 2
+    assert two.check("aa11") == OK
+    assert one.read("cc33") is None
+    # the staged object is there for the batch to rename the pointer
+    os.replace(staged, one.pointer_file("cc33"))
+    assert one.check("cc33") == OK
+
+
+def test_restore_returns_the_original_content(tmp_path):
+    store = make_store(tmp_path)
+    content = b"original bundle " * 1000
+    write(str(tmp_path / "game" / "aa11"), content)
+    back_up(store, str(tmp_path / "game" / "aa11"), "aa11")
+    write(str(tmp_path / "game" / "aa11"), b"mod")
+    dst = str(tmp_path / "game" / "aa11")
+    tmp, digest = store.stage_restore("aa11", dst, lambda src, dst: None)
+    os.replace(tmp, dst)
+    assert read(dst) == content
+    assert digest == store.digest("aa11")
@@ -0,0 +1,30 @@
+import os
+
+from conftest import read, write
+
+from manager import ModManager
+
+
+def test_refcounts_survive_a_session_without_close(tmp_path):
+    local = str(tmp_path / "local")
+    os.makedirs(local)
+    # the same content under two resource hashes, imported in two sessions
+    write(str(tmp_path / "one" / "ab" / "abcd"), b"shared")
+    write(str(tmp_path / "two" / "cd" / "cdef"), b"shared")
+    with ModManager(local) as manager:
+        first, = manager.import_resources(str(tmp_path / "one"))
+    manager = ModManager(local)
+    second, = manager.import_resources(str(tmp_path / "two"))
+    digest = manager.get_resource(second).digest
+    blob_path = manager.resource_manager.blob_store.blob_path(digest)
+    # no close
+    del manager
+
+    with ModManager(local) as manager:
+        assert manager.get_resource(first).digest == digest
+        manager.delete_resource(first)
+        assert os.path.exists(blob_path)
+        assert read(os.path.join(local, "resource", second, "cdef")) == b"shared"
+    with ModManager(local) as manager:
+        manager.delete_resource(second)
+        assert not os.path.exists(blob_path)
@@ -0,0 +1,110 @@
+import io
+import os
+import tarfile
+import zipfile
+from types import SimpleNamespace
+
+import pytest
+from conftest import read, write
+
+from manager import ModManager
+from manager import importer
+from manager.importer import resource_hash_of, scan
+
+# a pack as people zip it: resources in shards, plus what the OS and the author leave around
+PACK = {"ab/abcd": b"abcd", "cd/cdef": b"cdef", "readme/notes": b"notes", ".DS_Store": b"junk",
+        "__MACOSX/ab/._abcd": b"junk", "ab/x": b"junk"}
+
+
+def make_pack(root: str) -> str:
+    for name, content in PACK.items():
+        write(os.path.join(root, name), content)
+    return root
+
+
+def make_zip(path: str) -> str:
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, content in PACK.items():
+            archive.writestr(name, content)
+    return path
+
+
+def make_tar(path: str) -> str:
+    with tarfile.open(path, "w:gz") as archive:
+        for name, content in PACK.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    return path
+
+
+@pytest.fixture(params=["directory", "zip", "tar"])
+def pack(request, tmp_path):
+    if request.param == "directory":
+        return make_pack(str(tmp_path / "pack"))
+    if request.param == "zip":
+        return make_zip(str(tmp_path / "pack.zip"))
+    return make_tar(str(tmp_path / "pack.tar.gz"))
+
+
+def test_scan_skips_files_which_are_no_resources(pack):
+    with scan(pack) as (entries, parallel):
+        found = {entry.path.replace("\\", "/"): entry for entry in entries}
+        assert set(found) == {"ab/abcd", "cd/cdef", "readme/notes"}
+        for path, entry in found.items():
+            with entry.open() as stream:
+                assert stream.read() == PACK[path]
+    assert parallel == (not pack.endswith(".tar.gz"))
+
+
+def test_import_shard_only(pack, tmp_path):
+    local = str(tmp_path / "local")
+    os.makedirs(local)
+    with ModManager(local) as manager:
+        resource_ids = manager.import_resources(pack, shard_only=True)
+        assert sorted(manager.get_resource(resource_id).resource_hash for resource_id in resource_ids) == [
+            "abcd", "cdef"]
+        for resource_id in resource_ids:
+            resource = manager.get_resource(resource_id)
+            path = os.path.join(local, "resource", resource_id, resource.resource_hash)
+            assert read(path) == resource.resource_hash.encode()
+
+
+@pytest.mark.parametrize("path", ["x/..foo", "ab/x", "ab/.abcd", ""])
+def test_named_file_must_be_a_resource_hash(path):
+    with pytest.raises(ValueError):
+        resource_hash_of(path)
+
+
+class StubArchive:
+    """
+    What _SevenZipBatches uses of a py7zr archive
+    """
+
+    def __init__(self, members: dict[str, bytes]) -> None:
+        self.members = members
+        self.reads = []
+
+    def list(self):
+        return [SimpleNamespace(filename=name, is_directory=False, uncompressed=len(content))
+                for name, content in self.members.items()]
+
+    def reset(self):
+        pass
+
+    def read(self, names):
+        self.reads.append(list(names))
+        return {name: io.BytesIO(self.members[name]) for name in names}
+
+
+def test_7z_members_are_read_in_bounded_batches(monkeypatch):
+    monkeypatch.setattr(importer, "SEVEN_ZIP_BATCH", 10)
+    # an empty first member, one larger than a batch which still shares the empty one's batch, and two sharing one
+    archive = StubArchive({"ab/empty": b"", "cd/big": b"x" * 25, "ef/one": b"1" * 4, "ef/two": b"2" * 4,
+                           ".DS_Store": b"junk"})
+    entries = importer._scan_7z(archive)
+    assert [entry.path for entry in entries] == ["ab/empty", "cd/big", "ef/one", "ef/two"]
+    for entry in entries:
+        with entry.open() as stream:
+            assert stream.read() == archive.members[entry.path]
+    assert archive.reads == [["ab/empty", "cd/big"], ["ef/one", "ef/two"]]
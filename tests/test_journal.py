@@ -0,0 +1,60 @@
+import os
+
+from manager.journal import Journal
+
+
+def test_torn_tail_is_dropped(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.load()
+    journal.append({"op": "a"}, {"op": "b"})
+    journal.close()
+    size = os.path.getsize(journal.journal_path)
+    with open(journal.journal_path, "ab") as f:
+        f.write(b'{"op": "c", "se')
+
+    journal = Journal(str(tmp_path))
+    snapshot, ops = journal.load()
+    assert snapshot is None
+    assert [op["op"] for op in ops] == ["a", "b"]
+    assert os.path.getsize(journal.journal_path) == size
+
+    journal.append({"op": "c"})
+    journal.close()
+    _, ops = Journal(str(tmp_path)).load()
+    assert [(op["op"], op["seq"]) for op in ops] == [("a", 1), ("b", 2), ("c", 3)]
+
+
+def test_ops_in_the_snapshot_are_not_replayed(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.load()
+    journal.append({"op": "a"}, {"op": "b"})
+    journal.compact({"value": 1})
+    journal.append({"op": "c"})
+    journal.close()
+    # a crash between the snapshot and the truncation leaves the old log behind
+    with open(journal.journal_path, "rb") as f:
+        tail = f.read()
+    with open(journal.journal_path, "wb") as f:
+        f.write(b'{"op": "a", "seq": 1}\n{"op": "b", "seq": 2}\n' + tail)
+
+    snapshot, ops = Journal(str(tmp_path)).load()
+    assert snapshot["value"] == 1
+    assert [op["op"] for op in ops] == ["c"]
+
+
+def test_line_without_newline_is_torn(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.load()
+    journal.append({"op": "a"})
+    journal.close()
+    # the json of "b" is complete, the crash came before its newline
+    with open(journal.journal_path, "ab") as f:
+        f.write(b'{"op": "b", "seq": 2}')
+
+    journal = Journal(str(tmp_path))
+    _, ops = journal.load()
+    assert [op["op"] for op in ops] == ["a"]
+    journal.append({"op": "c"})
+    journal.close()
+    _, ops = Journal(str(tmp_path)).load()
+    assert [(op["op"], op["seq"]) for op in ops] == [("a", 1), ("c", 2)]
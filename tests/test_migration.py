@@ -0,0 +1,70 @@
+import json
+import os
+
+from conftest import read, write
+
+from manager import ModManager
+from manager.backup_store import POINTER_MAGIC
+
+
+def make_legacy_library(local, game, source, hashes):
+    """
+    A library of the first version: data.json, plain resource copies and plain
+    backups, with the mod applied to the game directory
+    """
+    resources = []
+    for i, resource_hash in enumerate(hashes):
+        resource_id = str(i + 2)
+        content = read(os.path.join(source, resource_hash[:2], resource_hash))
+        write(os.path.join(local, "resource", resource_id, resource_hash), content)
+        resources.append({"id": resource_id, "resource_hash": resource_hash, "name": resource_hash,
+                          "description": "", "resource_type": "card"})
+        game_file = os.path.join(game, resource_hash[:2], resource_hash)
+        write(os.path.join(local, "backup", resource_hash[:2], resource_hash), read(game_file))
+        write(game_file, content)
+    resource_ids = [resource["id"] for resource in resources]
+    with open(os.path.join(local, "data.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "mods": [{"id": "2", "name": "mod", "description": "", "resource_ids": resource_ids}],
+            "resources": resources,
+            "records": [{"id": "2", "resource_id": resource_id} for resource_id in resource_ids],
+            "max_mod_id": "2",
+            "max_resource_id": resource_ids[-1],
+        }, f)
+
+
+def test_data_json_moves_to_snapshot_and_default_target(tree):
+    local, game, source, hashes = tree
+    make_legacy_library(local, game, source, hashes)
+
+    with ModManager(local, game) as manager:
+        assert manager.get_targets() == {"default": game}
+        assert manager.get_stack() == ["2"]
+        assert manager.get_mod("2").resource_ids == [str(i + 2) for i in range(len(hashes))]
+        assert manager.verify().clean
+    assert not os.path.exists(os.path.join(local, "data.json"))
+    assert os.path.exists(os.path.join(local, "data.snapshot"))
+    assert os.path.exists(os.path.join(local, "target.snapshot"))
+    # backups became pointers into the object store
+    with open(os.path.join(local, "backup", hashes[0][:2], hashes[0]), "rb") as f:
+        assert f.read(len(POINTER_MAGIC)) == POINTER_MAGIC
+
+    # the records live with the default target now, reopening reads them from there
+    with ModManager(local) as manager:
+        assert manager.get_stack() == ["2"]
+        manager.reset_mod("2")
+    assert all(read(os.path.join(game, h[:2], h)) == b"orig" + h.encode() for h in hashes)
+
+
+def test_legacy_records_wait_for_the_game_directory(tree):
+    local, game, source, hashes = tree
+    make_legacy_library(local, game, source, hashes)
+
+    # opened without a game directory, only the library is usable
+    with ModManager(local) as manager:
+        assert manager.get_targets() == {}
+        assert len(manager.search_resources("")) == len(hashes)
+
+    with ModManager(local, game) as manager:
+        assert manager.get_stack() == ["2"]
+        assert manager.verify().clean
@@ -0,0 +1,115 @@
+import os
+
+import pytest
+from conftest import crash, game_files, write
+
+from manager import ModManager
+
+
+@pytest.fixture
+def two_mods(tree, tmp_path):
+    """
+    Mods "2" and "3" overriding every game file, "3" applied last on two installs
+    """
+    local, game, source, hashes = tree
+    second = str(tmp_path / "second")
+    other = str(tmp_path / "other")
+    for resource_hash in hashes:
+        write(os.path.join(second, resource_hash[:2], resource_hash), b"two" + resource_hash.encode())
+        write(os.path.join(other, resource_hash[:2], resource_hash), b"other" + resource_hash.encode())
+    with ModManager(local, game) as manager:
+        manager.add_target("other", other)
+        for path in (source, second):
+            resource_ids = [manager.add_resource(os.path.join(path, h[:2], h), h, "", "card") for h in hashes]
+            manager.add_mod(resource_ids, os.path.basename(path), "", None)
+        manager.deploy("2", ["default", "other"])
+        manager.deploy("3", ["default", "other"])
+    return local, game, other, hashes
+
+
+def contents(prefix: bytes, hashes):
+    return [prefix + h.encode() for h in hashes]
+
+
+def test_last_applied_wins_and_reset_uncovers(two_mods):
+    local, game, other, hashes = two_mods
+    with ModManager(local, game) as manager:
+        assert manager.get_stack() == ["2", "3"]
+        assert game_files(game, hashes) == contents(b"two", hashes)
+        manager.reset_mod("3")
+        assert game_files(game, hashes) == contents(b"mod", hashes)
+        manager.apply_mod("3")
+        manager.reset_mod("2")
+        assert game_files(game, hashes) == contents(b"two", hashes)
+        manager.reset_mod("3")
+        assert game_files(game, hashes) == contents(b"orig", hashes)
+        assert manager.verify().clean
+
+
+def test_priority_beats_apply_order_on_every_target(two_mods):
+    local, game, other, hashes = two_mods
+    with ModManager(local, game) as manager:
+        manager.set_priority("2", 5)
+        assert manager.get_stack() == ["3", "2"]
+        assert game_files(game, hashes) == contents(b"mod", hashes)
+        assert game_files(other, hashes) == contents(b"mod", hashes)
+        manager.reset_mod("2")
+        assert game_files(game, hashes) == contents(b"two", hashes)
+
+
+def test_unknown_mod_never_reaches_the_journal(two_mods):
+    local, game, other, hashes = two_mods
+    manager = ModManager(local, game)
+    with pytest.raises(KeyError):
+        manager.set_priority("999", 1)
+    with pytest.raises(KeyError):
+        manager._commit({"op": "set_priority", "mod_id": "999", "priority": 1})
+    # no close, the journal is replayed on the next start
+    del manager
+    with ModManager(local, game) as manager:
+        assert manager.get_stack() == ["2", "3"]
+
+
+# raises the priority of "2" on both installs, dying at `crash`
+PRIORITY_CHILD = """
+from manager import ModManager
+manager = ModManager({local!r}, {game!r})
+{crash}
+manager.set_priority("2", 5, progress=progress)
+"""
+
+# rewriting the files of the current install, with the new priority journaled
+CRASH_IN_BATCH = """
+def progress(done, total):
+    if done == total // 2:
+        os._exit(9)
+"""
+
+# the intents are written, the new priority is not journaled yet
+CRASH_BEFORE_PRIORITY = """
+progress = None
+commit = ModManager._commit
+def _commit(self, *ops):
+    if ops[0]["op"] == "set_priority":
+        os._exit(9)
+    commit(self, *ops)
+ModManager._commit = _commit
+"""
+
+
+@pytest.mark.parametrize("how, stack, prefix", [(CRASH_IN_BATCH, ["3", "2"], b"mod"),
+                                                 (CRASH_BEFORE_PRIORITY, ["2", "3"], b"two")],
+                         ids=["in_batch", "before_priority"])
+def test_interrupted_priority_change_agrees_with_the_journal(two_mods, how, stack, prefix):
+    local, game, other, hashes = two_mods
+    crash(PRIORITY_CHILD.format(local=local, game=game, crash=how), local)
+
+    with ModManager(local, game) as manager:
+        assert manager.get_stack() == stack
+        assert game_files(game, hashes) == contents(prefix, hashes)
+        manager.use_target("other")
+        assert manager.get_stack() == stack
+        assert game_files(other, hashes) == contents(prefix, hashes)
+        # the files follow the records, resetting the winner uncovers the other mod
+        manager.reset_mod(stack[-1])
+        assert game_files(other, hashes) == contents(b"mod" if prefix == b"two" else b"two", hashes)
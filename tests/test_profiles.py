@@ -0,0 +1,71 @@
+import os
+
+import pytest
+from conftest import game_files, write
+
+from manager import ModManager
+
+
+@pytest.fixture
+def manager(tree, tmp_path):
+    """
+    Mod "2" overriding the first half of the game files, mod "3" the second half
+    and mod "4" every file with the same content as "2" and "3"
+    """
+    local, game, source, hashes = tree
+    with ModManager(local, game) as manager:
+        resource_ids = [manager.add_resource(os.path.join(source, h[:2], h), h, "", "card") for h in hashes]
+        half = len(hashes) // 2
+        manager.add_mod(resource_ids[:half], "first", "", None)
+        manager.add_mod(resource_ids[half:], "second", "", None)
+        copy = str(tmp_path / "copy")
+        for h in hashes:
+            write(os.path.join(copy, h[:2], h), b"mod" + h.encode())
+        manager.add_mod([manager.add_resource(os.path.join(copy, h[:2], h), h, "", "card") for h in hashes],
+                        "both", "", None)
+    manager = ModManager(local, game)
+    yield manager, game, hashes
+    manager.close()
+
+
+def test_switch_only_writes_what_changes(manager):
+    manager, game, hashes = manager
+    manager.apply_mod("2")
+    manager.save_profile("first")
+    manager.save_profile("both", ["4"])
+    manager.save_profile("none", [])
+
+    # "4" has the content of "2" on the first half, only the second half is written
+    plan = manager.plan_profile("both")
+    assert len(plan.writes) == len(hashes) // 2
+    assert len(plan.unchanged) == len(hashes) // 2
+    assert not plan.restores
+    manager.switch_profile("both")
+    assert manager.get_stack() == ["4"]
+    assert game_files(game, hashes) == [b"mod" + h.encode() for h in hashes]
+
+    manager.switch_profile("first")
+    assert manager.get_stack() == ["2"]
+    half = len(hashes) // 2
+    assert game_files(game, hashes[half:]) == [b"orig" + h.encode() for h in hashes[half:]]
+
+    manager.switch_profile("none")
+    assert not manager.get_stack()
+    assert game_files(game, hashes) == [b"orig" + h.encode() for h in hashes]
+    assert manager.verify().clean
+
+
+def test_deleted_mod_leaves_the_profiles(manager):
+    manager, game, hashes = manager
+    manager.save_profile("two", ["2", "3"])
+    manager.delete_mod("3")
+    assert manager.get_profiles()["two"] == ["2"]
+    manager.switch_profile("two")
+    assert manager.get_stack() == ["2"]
+
+
+def test_unknown_mod_is_not_saved(manager):
+    manager, game, hashes = manager
+    with pytest.raises(KeyError):
+        manager.save_profile("bad", ["2", "999"])
+    assert "bad" not in manager.get_profiles()
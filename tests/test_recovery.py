@@ -0,0 +1,62 @@
+import glob
+import os
+
+from conftest import crash, game_files
+
+from manager import ModManager
+
+# applies the first mod in a child process which dies at `crash`
+CHILD = """
+from manager import ModManager
+from manager.intent import IntentLog
+manager = ModManager({local!r}, {game!r})
+{crash}
+manager.apply_mod(next(iter(manager.get_mods())).id, progress=progress)
+"""
+
+# half way through the batch, before anything is journaled
+CRASH_IN_BATCH = """
+def progress(done, total):
+    if done == total // 2:
+        os._exit(9)
+"""
+
+# after the records are journaled, before the intent is removed
+CRASH_AFTER_COMMIT = """
+progress = None
+IntentLog.end = lambda self: os._exit(9)
+"""
+
+
+def make_library(local, game, source, hashes):
+    with ModManager(local, game) as manager:
+        resource_ids = [manager.add_resource(os.path.join(source, resource_hash[:2], resource_hash),
+                                             resource_hash, "", "card") for resource_hash in hashes]
+        manager.add_mod(resource_ids, "mod", "", None)
+
+
+def test_interrupted_batch_is_rolled_back(tree):
+    local, game, source, hashes = tree
+    make_library(local, game, source, hashes)
+    crash(CHILD.format(local=local, game=game, crash=CRASH_IN_BATCH), local)
+    assert any(content.startswith(b"mod") for content in game_files(game, hashes))
+
+    with ModManager(local, game) as manager:
+        assert not os.path.exists(os.path.join(local, "intent.json"))
+        assert not glob.glob(os.path.join(game, "*", "*.mdtmp"))
+        assert game_files(game, hashes) == [b"orig" + h.encode() for h in hashes]
+        assert not manager.get_stack()
+        assert manager.verify().clean
+
+
+def test_committed_batch_is_kept(tree):
+    local, game, source, hashes = tree
+    make_library(local, game, source, hashes)
+    crash(CHILD.format(local=local, game=game, crash=CRASH_AFTER_COMMIT), local)
+
+    with ModManager(local, game) as manager:
+        assert not os.path.exists(os.path.join(local, "intent.json"))
+        assert game_files(game, hashes) == [b"mod" + h.encode() for h in hashes]
+        assert manager.get_stack() == ["2"]
+        manager.reset_mod("2")
+    assert game_files(game, hashes) == [b"orig" + h.encode() for h in hashes]